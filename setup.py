@@ -13,7 +13,8 @@ setup(name='smapp-toolkit',
           'pymongo>=3.0.1',
           'smappPy>=0.1.16',
           'networkx>=1.9.1',
-          'pandas>=0.16.1',
+          'numpy>=1.9.0',
+          'pandas>=0.17.0',
           'simplejson>=3.5.2'
       ]
      )
@@ -0,0 +1,447 @@
+"""
+Module contains mergeable aggregates that can be computed together in a single
+pass over a collection of tweets.
+
+An aggregate describes *what* to compute (e.g. the top 10 hashtags). Its partial
+state is a plain python object (a Counter, a set, an int ...) that is updated one
+tweet at a time and can be merged with the partial state of another part of the
+data. Per-tweet extraction (hashtags, mentions, tokens ...) is shared between all
+aggregates of a plan, so each is done at most once per tweet.
+
+Example:
+########
+from smapp_toolkit.twitter.aggregates import TopHashtags, LanguageCounts, CountBy
+
+results = collection.compute('top_mentions', 'unique_users',
+                             hashtags=TopHashtags(n=20),
+                             langs=LanguageCounts(['en', 'es', 'other']),
+                             sources=CountBy(lambda tweet: [tweet['source']]))
+results['hashtags']
+"""
+
+import pandas as pd
+from collections import Counter
+from smappPy.iter_util import get_ngrams
+from smappPy.retweet import is_official_retweet
+from smappPy.text_clean import get_cleaned_tokens
+from smappPy.entities import get_users_mentioned, get_hashtags
+from smappPy.entities import get_urls, get_links, get_image_urls
+
+from columns import _make_row
+from compact_ids import IdCounter, IdSet, IdMap
+from sketches import _new_counter, _merge_counters, HyperLogLog
+from counter_functions import _counter_to_series
+
+
+def _geolocation_names(tweet):
+    return [tweet['place']['full_name'] if 'place' in tweet and tweet['place'] is not None else None]
+
+FEATURES = {
+    'hashtags': lambda tweet: [h.lower() for h in get_hashtags(tweet)],
+    'mentions': get_users_mentioned,
+    'urls': get_urls,
+    'links': get_links,
+    'images': get_image_urls,
+    'geolocation_names': _geolocation_names,
+}
+
+
+class TweetFeatures(object):
+    """
+    Per-tweet extraction cache shared by all aggregates of a plan.
+    `features['hashtags']` extracts the hashtags of the current tweet the first
+    time it is asked for, and returns the cached list afterwards.
+    """
+    __slots__ = ('tweet', '_cache')
+
+    def __init__(self, tweet=None):
+        self.tweet = tweet
+        self._cache = {}
+
+    def reset(self, tweet):
+        self.tweet = tweet
+        self._cache.clear()
+
+    def __getitem__(self, name):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = FEATURES[name](self.tweet)
+            return value
+
+    def tokens(self, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=()):
+        key = ('tokens', hashtags, mentions, rts, mts, https, stopwords)
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = get_cleaned_tokens(self.tweet['text'],
+                                                          keep_hashtags=hashtags,
+                                                          keep_mentions=mentions,
+                                                          rts=rts,
+                                                          mts=mts,
+                                                          https=https,
+                                                          stopwords=stopwords)
+            return value
+
+
+def _describe_argument(value):
+    """
+    json-serializable description of an aggregate argument. Only plain values can be
+    described: the repr of a function is its address, which is reused by later functions.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_describe_argument(v) for v in value]
+    raise ValueError("{0!r} can not be fingerprinted".format(value))
+
+
+class Aggregate(object):
+    """
+    Base class for aggregates. Subclasses implement:
+        * empty()                 -> a fresh partial state
+        * update(state, features) -> the state updated with one tweet (`features.tweet`)
+        * merge(state, other)     -> the two partial states combined
+        * result(state)           -> the final result (usually a pandas Series)
+
+    `update` and `merge` may modify `state` in place, but must return it.
+    Aggregates that can't be computed per time slice set `groupable = False`.
+    """
+    groupable = True
+
+    def empty(self):
+        raise NotImplementedError
+
+    def update(self, state, features):
+        raise NotImplementedError
+
+    def merge(self, state, other):
+        raise NotImplementedError
+
+    def result(self, state):
+        raise NotImplementedError
+
+    def _describe(self):
+        """
+        Description of what this aggregate counts, used to fingerprint stored partial states.
+        Arguments that only affect `result()` (such as `n`) are left out.
+        Raises ValueError if an argument (e.g. the function of CountBy) can't be described.
+        """
+        return [type(self).__name__, sorted((name, _describe_argument(value)) for name, value in vars(self).iteritems() if name != 'n')]
+
+
+class RankedAggregate(Aggregate):
+    """
+    Base class for aggregates whose result is a top-`n` Series of counts.
+    Subclasses implement `counts(state)`, returning a Counter of all counts.
+    """
+    def __init__(self, n=10, capacity=None):
+        self.n = n
+        self.capacity = capacity
+
+    def counts(self, state):
+        return state
+
+    def result(self, state):
+        return _counter_to_series(self.counts(state), self.n)
+
+
+class CountFeature(RankedAggregate):
+    """
+    Counts the values of a per-tweet feature (one of `FEATURES`).
+    If `capacity` is given, counts are approximated in bounded memory
+    (see `sketches.FrequentItems`).
+
+    Example:
+    ########
+    CountFeature('hashtags', n=10)
+    """
+    def __init__(self, feature, n=10, capacity=None):
+        RankedAggregate.__init__(self, n, capacity)
+        self.feature = feature
+
+    def empty(self):
+        return _new_counter(self.capacity)
+
+    def update(self, state, features):
+        state.update(features[self.feature])
+        return state
+
+    def merge(self, state, other):
+        return _merge_counters(state, other)
+
+
+class TopHashtags(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'hashtags', n, capacity)
+
+class TopMentions(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'mentions', n, capacity)
+
+class TopUrls(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'urls', n, capacity)
+
+class TopLinks(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'links', n, capacity)
+
+class TopImages(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'images', n, capacity)
+
+class TopGeolocationNames(CountFeature):
+    def __init__(self, n=10, capacity=None):
+        CountFeature.__init__(self, 'geolocation_names', n, capacity)
+
+
+class CountBy(RankedAggregate):
+    """
+    Custom counter. `func` takes a tweet and returns an iterable of keys to count.
+
+    Example:
+    ########
+    CountBy(lambda tweet: [tweet['source']], n=5)
+    """
+    def __init__(self, func, n=10, capacity=None):
+        RankedAggregate.__init__(self, n, capacity)
+        self.func = func
+
+    def empty(self):
+        return _new_counter(self.capacity)
+
+    def update(self, state, features):
+        state.update(self.func(features.tweet))
+        return state
+
+    def merge(self, state, other):
+        return _merge_counters(state, other)
+
+
+class TopNgrams(RankedAggregate):
+    """
+    Counts n-grams of tokenized tweet texts. See `top_unigrams()` for the tokenizer arguments.
+    """
+    def __init__(self, ngram=1, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[],
+        capacity=None):
+        RankedAggregate.__init__(self, n, capacity)
+        self.ngram = ngram
+        self.tokenizer_args = (hashtags, mentions, rts, mts, https, tuple(stopwords))
+
+    def empty(self):
+        return _new_counter(self.capacity)
+
+    def update(self, state, features):
+        tokens = features.tokens(*self.tokenizer_args)
+        state.update(' '.join(e) for e in get_ngrams(tokens, self.ngram))
+        return state
+
+    def merge(self, state, other):
+        return _merge_counters(state, other)
+
+class TopUnigrams(TopNgrams):
+    def __init__(self, n=10, **tokenizer_args):
+        TopNgrams.__init__(self, 1, n, **tokenizer_args)
+
+class TopBigrams(TopNgrams):
+    def __init__(self, n=10, **tokenizer_args):
+        TopNgrams.__init__(self, 2, n, **tokenizer_args)
+
+class TopTrigrams(TopNgrams):
+    def __init__(self, n=10, **tokenizer_args):
+        TopNgrams.__init__(self, 3, n, **tokenizer_args)
+
+
+class TopUserLocations(RankedAggregate):
+    """
+    Counts user location strings. If `count_each_user_once` is True, only the
+    location of the first tweet seen from each user is considered.
+    """
+    def __init__(self, n=10, count_each_user_once=True):
+        RankedAggregate.__init__(self, n)
+        self.count_each_user_once = count_each_user_once
+
+    def empty(self):
+        return IdMap() if self.count_each_user_once else Counter()
+
+    def update(self, state, features):
+        user = features.tweet['user']
+        if self.count_each_user_once:
+            state.add(user['id'], user['location'])
+        elif user['location']:
+            state[user['location']] += 1
+        return state
+
+    def merge(self, state, other):
+        if self.count_each_user_once:
+            state.merge(other)
+        else:
+            state.update(other)
+        return state
+
+    def counts(self, state):
+        if self.count_each_user_once:
+            return Counter(dict((location, count) for location, count in state.value_counts().iteritems() if location))
+        return state
+
+
+class LanguageCounts(Aggregate):
+    """
+    Counts tweets per language in `langs`. 'other' counts all the languages not in `langs`.
+    """
+    def __init__(self, langs=['en', 'other']):
+        self.langs = list(langs)
+
+    def empty(self):
+        return Counter()
+
+    def update(self, state, features):
+        state[features.tweet.get('lang')] += 1
+        return state
+
+    def merge(self, state, other):
+        state.update(other)
+        return state
+
+    def result(self, state):
+        counts = Counter(state)
+        if 'other' in self.langs:
+            counts['other'] = sum(ct for lang, ct in state.items() if lang not in self.langs)
+        return pd.Series([counts[l] for l in self.langs], index=self.langs)
+
+
+class UniqueUsers(Aggregate):
+    """
+    Counts distinct users, exactly (an IdSet of user ids) or, if `approximate` is True,
+    with a HyperLogLog sketch of 2 ** `precision` bytes.
+    """
+    def __init__(self, approximate=False, precision=14):
+        self.approximate = approximate
+        self.precision = precision
+
+    def empty(self):
+        return HyperLogLog(self.precision) if self.approximate else IdSet()
+
+    def update(self, state, features):
+        state.add(features.tweet['user']['id'])
+        return state
+
+    def merge(self, state, other):
+        state |= other
+        return state
+
+    def result(self, state):
+        return pd.Series([len(state)], index=['unique_users'])
+
+
+class TweetCount(Aggregate):
+    def empty(self):
+        return 0
+
+    def update(self, state, features):
+        return state + 1
+
+    def merge(self, state, other):
+        return state + other
+
+    def result(self, state):
+        return pd.Series([state], index=['count'])
+
+
+class TopRetweets(Aggregate):
+    """
+    Most retweeted tweets, as a DataFrame with the `rt_columns` of the original tweets.
+    """
+    groupable = False
+
+    def __init__(self, n=10, rt_columns=['user.screen_name', 'created_at', 'text']):
+        self.n = n
+        self.rt_columns = list(rt_columns)
+
+    def empty(self):
+        return (IdCounter(), dict())
+
+    def update(self, state, features):
+        tweet = features.tweet
+        if is_official_retweet(tweet):
+            counts, rows = state
+            tid = tweet['retweeted_status']['id']
+            counts.add(tid)
+            if tid not in rows:
+                rows[tid] = tuple(_make_row(tweet['retweeted_status'], self.rt_columns))
+        return state
+
+    def merge(self, state, other):
+        state[0].merge(other[0])
+        for tid, row in other[1].iteritems():
+            state[1].setdefault(tid, row)
+        return state
+
+    def result(self, state):
+        counts, rows = state
+        return pd.DataFrame([[tid, tcount] + list(rows[tid]) for tid, tcount in counts.most_common(self.n)],
+            columns=['id', 'count']+self.rt_columns)
+
+
+NAMED_AGGREGATES = {
+    'count': TweetCount,
+    'unique_users': UniqueUsers,
+    'language_counts': LanguageCounts,
+    'top_hashtags': TopHashtags,
+    'top_mentions': TopMentions,
+    'top_urls': TopUrls,
+    'top_links': TopLinks,
+    'top_images': TopImages,
+    'top_geolocation_names': TopGeolocationNames,
+    'top_user_locations': TopUserLocations,
+    'top_unigrams': TopUnigrams,
+    'top_bigrams': TopBigrams,
+    'top_trigrams': TopTrigrams,
+    'top_retweets': TopRetweets,
+}
+
+
+def make_plan(names, aggregates):
+    """
+    Builds a plan (a dict of name -> Aggregate) from aggregate names, e.g. 'top_hashtags',
+    which are computed with their default arguments, and from named Aggregate objects.
+    """
+    plan = dict()
+    for name in names:
+        if name not in NAMED_AGGREGATES:
+            raise ValueError("Unknown aggregate '{}'. Known aggregates are {}.".format(name, sorted(NAMED_AGGREGATES)))
+        plan[name] = NAMED_AGGREGATES[name]()
+    for name, aggregate in aggregates.iteritems():
+        if not isinstance(aggregate, Aggregate):
+            raise TypeError("'{}' is not an Aggregate ({!r})".format(name, aggregate))
+        plan[name] = aggregate
+    if not plan:
+        raise ValueError("Nothing to compute")
+    return plan
+
+def run_plan(plan, tweets, states=None):
+    """
+    Feeds each tweet to every aggregate of `plan` in a single pass.
+    Returns the dict of name -> partial state, updating `states` if given.
+    """
+    items = plan.items()
+    if states is None:
+        states = empty_states(plan)
+    features = TweetFeatures()
+    for tweet in tweets:
+        features.reset(tweet)
+        for name, aggregate in items:
+            states[name] = aggregate.update(states[name], features)
+    return states
+
+def empty_states(plan):
+    return dict((name, aggregate.empty()) for name, aggregate in plan.iteritems())
+
+def merge_states(plan, states, other):
+    for name, aggregate in plan.iteritems():
+        states[name] = aggregate.merge(states[name], other[name])
+    return states
+
+def plan_results(plan, states):
+    return dict((name, aggregate.result(states[name])) for name, aggregate in plan.iteritems())
@@ -1,15 +1,189 @@
+import os
+import copy
+import json
+import pickle
+import hashlib
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from collections import Counter, defaultdict
+from datetime import timedelta
+from collections import Counter, defaultdict, OrderedDict
 
 from smappPy.retweet import is_retweet
 from smappPy.geo_tweet import is_geocoded
 from smappPy.entities import contains_url, contains_image, contains_hashtag, contains_mention
 
 import mongo_tweet_collection
+from cache import _describe_value
+from sketches import FrequentItems
+from windows import SlidingWindow
+from time_buckets import BUCKET_NANOSECONDS, bucket_starts, is_coarser
+from aggregates import make_plan, run_plan, empty_states, merge_states, RankedAggregate, TweetCount, UniqueUsers, LanguageCounts, \
+    TopUserLocations, TopUnigrams, TopBigrams, TopTrigrams, TopLinks, TopUrls, TopImages, TopHashtags, TopMentions, \
+    TopGeolocationNames
 from counter_functions import _top_user_locations, _top_unigrams, _top_bigrams, _top_trigrams, _top_links, _top_urls, \
-    _top_images, _top_hashtags, _top_mentions, _top_geolocation_names, _counter_to_series, _language_counts, \
-    _unique_users
+    _top_images, _top_hashtags, _top_mentions, _top_geolocation_names, _counter_to_series, \
+    _unique_users, _language_counts
+
+
+class _TopNTracker(object):
+    """
+    Picks the `n` entries with the highest total count over all time slices.
+    By default every count of every slice is kept, and the result is exact. With
+    `candidates`, only the top `candidates` entries of each slice are kept, with a
+    bounded summary of the totals: an entry that is not among the top `candidates` of
+    a slice is then missing (NaN) for that slice, unless exact counts are filled in
+    with `set_exact()`.
+    """
+    def __init__(self, n, candidates=None):
+        self.n = n
+        self.candidates = candidates
+        self.times = list()
+        self.kept = dict()
+        self.totals = Counter() if candidates is None else FrequentItems(10 * candidates)
+
+    def add(self, t, top_pairs):
+        """
+        `top_pairs` are the (entry, count) pairs of a slice, ordered by decreasing count.
+        """
+        if self.candidates is not None:
+            top_pairs = top_pairs[:self.candidates]
+        self.times.append(t)
+        self.kept[t] = dict(top_pairs)
+        self.totals.update(self.kept[t])
+
+    def winners(self):
+        return [entry for entry, _ in self.totals.most_common(self.n)]
+
+    def set_exact(self, t, counts):
+        """
+        Replace the kept counts of slice `t` by `counts` (a mapping with the exact counts of the winners).
+        """
+        self.kept[t] = counts
+
+    def frame(self):
+        winners = self.winners()
+        rows = dict()
+        for t in self.times:
+            kept = self.kept[t]
+            rows[t] = dict((w, kept[w]) for w in winners if w in kept)
+        return pd.DataFrame.from_dict(rows, orient='index').reindex(index=sorted(self.times), columns=winners)
+
+
+def _long_to_frame(times, keys, values, index=(), sort_columns=False):
+    """
+    Pivots long format (time, key, value) records into a DataFrame with a row per time
+    (sorted) and a column per key, in order of first appearance or sorted if `sort_columns`.
+    Missing cells are NaN. Times in `index` get a row even if they have no records.
+    """
+    rows = OrderedDict((t, i) for i, t in enumerate(index))
+    columns = OrderedDict()
+    row_positions = [rows.setdefault(t, len(rows)) for t in times]
+    column_positions = [columns.setdefault(key, len(columns)) for key in keys]
+    values = np.asarray(values)
+    if values.dtype.kind in 'biuf':
+        data = np.empty((len(rows), len(columns)), dtype=np.float64)
+    else:
+        data = np.empty((len(rows), len(columns)), dtype=object)
+    data.fill(np.nan)
+    if len(values):
+        data[row_positions, column_positions] = values
+    if values.dtype.kind in 'biu' and len(values) == data.size:
+        data = data.astype(np.int64)
+    ret = pd.DataFrame(data, index=list(rows), columns=list(columns)).sort_index()
+    if sort_columns:
+        try:
+            ret = ret[sorted(columns)]
+        except TypeError:
+            pass
+    return ret
+
+def _series_to_frame(results):
+    """
+    Assembles the (time, Series) pairs in `results` into a DataFrame with a row per time,
+    like `pd.concat(dict(results), axis=1).T`: columns are sorted unless all Series have
+    the same index.
+    """
+    times, keys, values = list(), list(), list()
+    aligned = True
+    for t, series in results:
+        aligned = aligned and series.index.equals(results[0][1].index)
+        times.extend([t] * len(series))
+        keys.extend(series.index)
+        values.extend(series.values)
+    return _long_to_frame(times, keys, values, index=[t for t, _ in results], sort_columns=not aligned)
+
+def _groupable_plan(names, aggregates):
+    plan = make_plan(names, aggregates)
+    for name, aggregate in plan.iteritems():
+        if not aggregate.groupable:
+            raise ValueError("'{}' can not be computed per time slice".format(name))
+    return plan
+
+def _plan_frames(plan, slices):
+    """
+    Builds a DataFrame per aggregate of `plan` from the (time, states) pairs in `slices`.
+    Ranked aggregates keep the columns of their `n` overall top entries.
+    """
+    results = dict()
+    for name, aggregate in plan.iteritems():
+        results[name] = _TopNTracker(aggregate.n) if isinstance(aggregate, RankedAggregate) else list()
+    for t, states in slices:
+        for name, aggregate in plan.iteritems():
+            if isinstance(aggregate, RankedAggregate):
+                tracker = results[name]
+                tracker.add(t, aggregate.counts(states[name]).most_common(tracker.candidates))
+            else:
+                results[name].append((t, aggregate.result(states[name])))
+    ret = dict()
+    for name, aggregate in plan.iteritems():
+        if isinstance(aggregate, RankedAggregate):
+            ret[name] = results[name].frame()
+        else:
+            ret[name] = _series_to_frame(results[name])
+    return ret
+
+
+class GroupedPartials(object):
+    """
+    Partial results of several aggregates per time slice, as returned by `Aggregator.partials()`.
+    `results()` gives a DataFrame per aggregate, and `rollup(time_unit)` merges the slices
+    into coarser ones ('minutes', 'hours', 'days', 'weeks' or 'months').
+    """
+    def __init__(self, plan, time_unit, slices):
+        self.plan = plan
+        self.time_unit = time_unit
+        self.slices = slices
+
+    def __repr__(self):
+        return "GroupedPartials(time_unit={0}, slices={1}, aggregates={2})".format(
+            self.time_unit, len(self.slices), sorted(self.plan))
+
+    def results(self):
+        return _plan_frames(self.plan, self.slices)
+
+    def rollup(self, time_unit):
+        if not is_coarser(time_unit, self.time_unit):
+            raise ValueError("Can not roll '{}' up into '{}'".format(self.time_unit, time_unit))
+        merged = OrderedDict()
+        starts = bucket_starts([t for t, _ in self.slices], time_unit).tolist()
+        for start, (t, states) in zip(starts, self.slices):
+            if start not in merged:
+                merged[start] = empty_states(self.plan)
+            merge_states(self.plan, merged[start], states)
+        slices = [(pd.Timestamp(start).to_pydatetime(), states) for start, states in merged.iteritems()]
+        return GroupedPartials(self.plan, time_unit, slices)
+
+
+def _can_fingerprint(obj):
+    """
+    Whether an aggregate or a collection can be described in a fingerprint.
+    """
+    try:
+        obj._describe()
+    except ValueError:
+        return False
+    return True
 
 
 class Aggregator(object):
@@ -23,12 +197,25 @@ class Aggregator(object):
         col = smapp_toolkit.twitter.BSONTweetCollection('tweets.bson') # or MongoTweetCollection()
         agg = smapp_toolkit.twitter.aggregator.Aggregator(col, 'hours')
         d = agg.top_user_locations(10)
+
+    Time slices are cut as the timestamps of a sorted collection cross slice boundaries.
+    With `assume_sorted=False`, each tweet is instead hashed into its time bucket in a
+    single pass, which gives correct results for collections in any order (e.g. stream
+    captures). Only `compute()` and the built-in top_x(), count(), language_counts()
+    and unique_users() methods are available in that mode.
+
+    For a MongoTweetCollection, each time slice is a separate query. With `workers`
+    set, up to that many slices are queried at once (in threads), so a long report is
+    not one round-trip after another. Results are the same, in the same order.
     """
 
-    def __init__(self, collection, time_unit):
+    def __init__(self, collection, time_unit, assume_sorted=True, workers=None):
         self._collection = collection
         self._time_unit = time_unit
         self._time_delta = timedelta(**{time_unit: 1})
+        self._assume_sorted = assume_sorted
+        self._store_path = None
+        self._workers = workers
 
     def _get_start_time(self):
         for t in self._collection:
@@ -45,6 +232,9 @@ class Aggregator(object):
         return start_time
 
     def __iter__(self):
+        if not self._assume_sorted:
+            raise ValueError("Time slices can not be iterated over with assume_sorted=False. "
+                             "Use compute() or the built-in top_x() methods instead.")
         if isinstance(self._collection, mongo_tweet_collection.MongoTweetCollection):
             return self._mongo_splits()
         else:
@@ -88,47 +278,310 @@ class Aggregator(object):
             yield (start_time, tmpcol)
             start_time = start_time + self._time_delta
 
+    def _bucketed_states(self, plan, batch_size=10000):
+        """
+        Single pass over the collection, in any order: tweets are assigned to their time
+        bucket a batch at a time, and a partial state of `plan` is kept per bucket.
+        Returns (time, states) pairs for every bucket from the first to the last, in order.
+        """
+        buckets = dict()
+        self._fill_buckets(plan, buckets, self._collection, batch_size)
+        return self._bucket_range(plan, buckets)
+
+    def _fill_buckets(self, plan, buckets, tweets, batch_size=10000):
+        batch = list()
+        for tweet in tweets:
+            batch.append(tweet)
+            if len(batch) >= batch_size:
+                self._add_to_buckets(plan, buckets, batch)
+                batch = list()
+        self._add_to_buckets(plan, buckets, batch)
+
+    def _bucket_range(self, plan, buckets):
+        ret = list()
+        if not buckets:
+            return ret
+        start, last = min(buckets), max(buckets)
+        while start <= last:
+            states = buckets[start] if start in buckets else empty_states(plan)
+            ret.append((pd.Timestamp(start).to_pydatetime(), states))
+            start += BUCKET_NANOSECONDS[self._time_unit]
+        return ret
+
+    def _add_to_buckets(self, plan, buckets, batch):
+        if not batch:
+            return
+        groups = defaultdict(list)
+        for start, tweet in zip(bucket_starts([tweet['timestamp'] for tweet in batch], self._time_unit).tolist(), batch):
+            groups[start].append(tweet)
+        for start, tweets in groups.iteritems():
+            buckets[start] = run_plan(plan, tweets, buckets.get(start))
+
+    def incremental(self, store_path):
+        """
+        Keep the partial results of each time slice in `store_path`, so that later calls with
+        the same collection filters, time unit and aggregates only read the tweets added since
+        (past the last byte read of a BSON file, or the highest `_id` of Mongo collections)
+        and merge them in. Like `assume_sorted=False`, tweets may be in any order and only
+        `compute()` and the built-in top_x(), count(), language_counts() and unique_users()
+        methods are available. Aggregates with custom functions (e.g. CountBy), and collections
+        with a `sample()` or a `limit()`, are recomputed each time, since they can't be
+        fingerprinted.
+
+        Example:
+        ########
+        hourly = collection.group_by('hours').incremental('/home/smapp/aggregates')
+        hourly.top_hashtags(10)      # reads the whole collection
+        hourly.top_hashtags(10)      # later: only reads the new tweets
+        """
+        ret = copy.copy(self)
+        ret._assume_sorted = False
+        ret._store_path = store_path
+        return ret
+
+    def _fingerprint(self, plan):
+        description = [self._collection._describe(), self._time_unit,
+                       sorted((name, aggregate._describe()) for name, aggregate in plan.iteritems())]
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=_describe_value)).hexdigest()
+
+    def _materialized_states(self, plan):
+        """
+        Like `_bucketed_states`, but starts from the partial states stored in `self._store_path`
+        and only reads the tweets after their watermark. The merged states are stored back.
+        """
+        if not os.path.isdir(self._store_path):
+            os.makedirs(self._store_path)
+        path = os.path.join(self._store_path, self._fingerprint(plan) + '.pickle')
+        stored = None
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                stored = pickle.load(f)
+        if stored is not None and self._collection._is_valid_watermark(stored['watermark']):
+            watermark, buckets = stored['watermark'], stored['buckets']
+        else:
+            watermark, buckets = None, dict()
+        progress = {'watermark': watermark}
+        self._fill_buckets(plan, buckets, self._collection._tweets_after(watermark, progress))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'watermark': progress['watermark'], 'buckets': buckets}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        return self._bucket_range(plan, buckets)
+
+    def _plan_states(self, plan):
+        """
+        (time, states) pairs of `plan`, per time slice.
+        """
+        if self._store_path and _can_fingerprint(self._collection):
+            stored = dict((name, aggregate) for name, aggregate in plan.iteritems() if _can_fingerprint(aggregate))
+            if len(stored) == len(plan):
+                return self._materialized_states(plan)
+            recomputed = dict((name, aggregate) for name, aggregate in plan.iteritems() if name not in stored)
+            if not stored:
+                return self._bucketed_states(recomputed)
+            return self._joined_states(plan, self._materialized_states(stored), self._bucketed_states(recomputed))
+        if not self._assume_sorted:
+            return self._bucketed_states(plan)
+        return ((t, run_plan(plan, split)) for t, split in self)
+
+    def _joined_states(self, plan, *parts):
+        """
+        Joins (time, states) pairs of parts of `plan` into (time, states) pairs of `plan`.
+        """
+        slices = dict()
+        for part in parts:
+            for t, states in part:
+                slices.setdefault(t, empty_states(plan)).update(states)
+        return sorted(slices.iteritems())
+
+    def sliding_window(self, size=60, feature='hashtags', terms=None):
+        """
+        Returns a `windows.SlidingWindow` of the last `size` time slices, filled with the
+        tweets of the collection. Keep it up to date with `update(new_tweets)`.
+        See `SlidingWindow` for `feature` and `terms`.
+
+        Example:
+        ########
+        window = collection.since(datetime.utcnow() - timedelta(hours=1)).group_by('minutes').sliding_window(60)
+        window.top(10)
+        window.bursts(threshold=3)
+        """
+        window = SlidingWindow(size, self._time_unit, feature, terms)
+        window.update(self._collection)
+        return window
+
+    def _computed(self, aggregate):
+        return self.compute(result=aggregate)['result']
+
+    def _slice_results(self, callable_, *args, **kwargs):
+        """
+        Yields (time, `callable_(split, *args, **kwargs)`) for each time slice, in order.
+        Mongo slices are run on a pool of `self._workers` threads if set.
+        """
+        if not self._workers or not isinstance(self._collection, mongo_tweet_collection.MongoTweetCollection):
+            for t, split in self:
+                yield t, callable_(split, *args, **kwargs)
+            raise StopIteration()
+        def run(slice_):
+            t, split = slice_
+            return t, callable_(split, *args, **kwargs)
+        pool = ThreadPool(self._workers)
+        try:
+            for result in pool.imap(run, self):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
     def grouped_result(self, callable_, *args, **kwargs):
-        results = dict()
-        for t, split in self:
-            results[t] = callable_(split, *args, **kwargs)
-        return pd.concat(results, axis=1).T
+        return _series_to_frame(list(self._slice_results(callable_, *args, **kwargs)))
+
+    def _bucket_key_counts(self, key_index, n_keys, batch_size=100000):
+        """
+        Counts tweets per (time slice, key) in a single pass over the collection, in any order.
+        Timestamps are collected a batch at a time and bucketed with integer arithmetic.
+        `key_index(tweet)` returns the column of a tweet (0 to `n_keys` - 1), or None to only
+        count it towards the time range. Returns a DataFrame with a row per time slice, from
+        the first to the last, and a column per key index.
+        """
+        step = BUCKET_NANOSECONDS[self._time_unit]
+        width = n_keys + 1
+        totals = Counter()
+        batch = {'timestamps': list(), 'keys': list()}
+
+        def flush():
+            if not batch['timestamps']:
+                return
+            buckets = bucket_starts(batch['timestamps'], self._time_unit) // step
+            codes, counts = np.unique(buckets * width + np.array(batch['keys'], dtype=np.int64), return_counts=True)
+            totals.update(dict(zip(codes.tolist(), counts.tolist())))
+            batch['timestamps'] = list()
+            batch['keys'] = list()
+
+        for tweet in self._collection:
+            key = key_index(tweet)
+            batch['timestamps'].append(tweet['timestamp'])
+            batch['keys'].append(n_keys if key is None else key)
+            if len(batch['timestamps']) >= batch_size:
+                flush()
+        flush()
+        if not totals:
+            return pd.DataFrame(columns=range(n_keys), dtype=np.int64)
+        codes = np.array(totals.keys(), dtype=np.int64)
+        buckets, keys = codes // width, codes % width
+        first = buckets.min()
+        data = np.zeros((buckets.max() - first + 1, width), dtype=np.int64)
+        data[buckets - first, keys] = totals.values()
+        index = pd.to_datetime((first + np.arange(len(data))) * step)
+        return pd.DataFrame(data[:, :n_keys], index=index)
+
+    def grouped_top_n_result(self, n, callable_, candidates=None, exact=False):
+        """
+        Runs `callable_` on each time slice and returns the counts of the `n` entries with
+        the highest total over all slices.
+
+        All the counts of every slice are kept until the top entries are known. To keep
+        memory bounded instead, pass `candidates`: only the top `candidates` entries of
+        each slice are kept, so the top entries are approximate and an entry that is not
+        among them has no count (NaN) for that slice. With `exact=True`, the slices are
+        then read a second time to fill in the exact counts of the `n` chosen entries.
+        """
+        if candidates is None:
+            res = self.grouped_result(callable_)
+            su = res.sum().sort_values(ascending=False)
+            return res[list(su[:n].index)]
+        tracker = _TopNTracker(n, candidates)
+        for t, res in self._slice_results(callable_):
+            tracker.add(t, list(res.nlargest(tracker.candidates).iteritems()))
+        if exact:
+            winners = tracker.winners()
+            for t, res in self._slice_results(callable_):
+                tracker.set_exact(t, res[res.index.isin(winners)].to_dict())
+        return tracker.frame()
 
-    def grouped_top_n_result(self, n, callable_):
-        res = self.grouped_result(callable_)
-        su = res.sum()
-        su.sort(ascending=False)
-        return res[list(su[:n].index)]
+    def compute(self, *names, **aggregates):
+        """
+        Computes several aggregates per time slice, in a single pass over each slice.
+        Takes the same arguments as `collection.compute()`, and returns a dict with
+        a DataFrame per aggregate. Ranked aggregates (top_x) keep the columns of the
+        `n` overall top entries, like the top_x() methods of the Aggregator.
 
-    def top_user_locations(self, n=10):
-        return self.grouped_top_n_result(n, _top_user_locations)
+        Example:
+        ########
+        from smapp_toolkit.twitter.aggregates import TopHashtags
+        results = collection.group_by('hours').compute('count', 'unique_users', hashtags=TopHashtags(n=5))
+        results['hashtags']
+        """
+        plan = _groupable_plan(names, aggregates)
+        return _plan_frames(plan, self._plan_states(plan))
 
-    def top_unigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-        return self.grouped_top_n_result(n, lambda col: _top_unigrams(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords))
+    def partials(self, *names, **aggregates):
+        """
+        Computes the partial results of several aggregates per time slice, and keeps them
+        in memory as a `GroupedPartials`. Results by coarser time units ('hours', 'days',
+        'weeks', 'months') can then be rolled up from them without reading the tweets again.
+        Takes the same arguments as `compute()`.
 
-    def top_bigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-        return self.grouped_top_n_result(n, lambda col: _top_bigramss(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords))
+        Example:
+        ########
+        partials = collection.group_by('minutes').partials('count', 'unique_users', 'top_hashtags')
+        by_minute = partials.results()
+        by_day = partials.rollup('days').results()
+        by_week = partials.rollup('weeks').results()
+        by_day['unique_users']
+        """
+        plan = _groupable_plan(names, aggregates)
+        return GroupedPartials(plan, self._time_unit, list(self._plan_states(plan)))
 
-    def top_trigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-        return self.grouped_top_n_result(n, lambda col: _top_trigrams(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords))
+    def top_user_locations(self, n=10, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopUserLocations(n))
+        return self.grouped_top_n_result(n, _top_user_locations, candidates=candidates, exact=exact)
 
-    def top_links(self, n=10):
-        return self.grouped_top_n_result(n, _top_links)
+    def top_unigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopUnigrams(n, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity))
+        return self.grouped_top_n_result(n, lambda col: _top_unigrams(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity), candidates=candidates, exact=exact)
 
-    def top_urls(self, n=10):
-        return self.grouped_top_n_result(n, _top_urls)
+    def top_bigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopBigrams(n, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity))
+        return self.grouped_top_n_result(n, lambda col: _top_bigrams(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity), candidates=candidates, exact=exact)
 
-    def top_images(self, n=10):
-        return self.grouped_top_n_result(n, _top_images)
+    def top_trigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopTrigrams(n, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity))
+        return self.grouped_top_n_result(n, lambda col: _top_trigrams(col, n=None, hashtags=hashtags, mentions=mentions, rts=rts, mts=mts, https=https, stopwords=stopwords, capacity=capacity), candidates=candidates, exact=exact)
 
-    def top_hashtags(self, n=10):
-        return self.grouped_top_n_result(n, _top_hashtags)
+    def top_links(self, n=10, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopLinks(n))
+        return self.grouped_top_n_result(n, _top_links, candidates=candidates, exact=exact)
 
-    def top_mentions(self, n=10):
-        return self.grouped_top_n_result(n, _top_mentions)
+    def top_urls(self, n=10, capacity=None, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopUrls(n, capacity=capacity))
+        return self.grouped_top_n_result(n, lambda col: _top_urls(col, capacity=capacity), candidates=candidates, exact=exact)
 
-    def top_geolocation_names(self, n=10):
-        return self.grouped_top_n_result(n, _top_geolocation_names)
+    def top_images(self, n=10, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopImages(n))
+        return self.grouped_top_n_result(n, _top_images, candidates=candidates, exact=exact)
+
+    def top_hashtags(self, n=10, capacity=None, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopHashtags(n, capacity=capacity))
+        return self.grouped_top_n_result(n, lambda col: _top_hashtags(col, capacity=capacity), candidates=candidates, exact=exact)
+
+    def top_mentions(self, n=10, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopMentions(n))
+        return self.grouped_top_n_result(n, _top_mentions, candidates=candidates, exact=exact)
+
+    def top_geolocation_names(self, n=10, candidates=None, exact=False):
+        if not self._assume_sorted:
+            return self._computed(TopGeolocationNames(n))
+        return self.grouped_top_n_result(n, _top_geolocation_names, candidates=candidates, exact=exact)
 
     def entities_counts(self, urls=True, images=True, hashtags=True, mentions=True, geo_enabled=True, retweets=True):
         def props(collection, urls=urls, images=images, hashtags=hashtags, mentions=mentions, geo_enabled=geo_enabled, retweets=retweets):
@@ -151,13 +604,49 @@ class Aggregator(object):
         return self.grouped_result(props)
 
     def language_counts(self, langs):
-        return self.grouped_result(_language_counts, langs=langs)
+        """
+        Counts the tweets of each language in `langs` ('other' counts the rest) per time
+        slice, in a single pass over the collection. The rows go from the first to the last
+        slice with tweets. On a Mongo collection with `workers`, the slices are queried
+        one by one on the workers instead, and the rows cover the whole `since()`/`until()`
+        range.
+        """
+        if self._store_path:
+            return self._computed(LanguageCounts(langs))
+        if self._assume_sorted and self._workers and isinstance(self._collection, mongo_tweet_collection.MongoTweetCollection):
+            return self.grouped_result(_language_counts, langs=langs)
+        columns = dict((lang, i) for i, lang in enumerate(langs))
+        other = columns.get('other')
+        res = self._bucket_key_counts(lambda tweet: columns.get(tweet.get('lang'), other), len(langs))
+        res.columns = list(langs)
+        return res
 
     def count(self):
-        if isinstance(self._collection, mongo_tweet_collection.MongoTweetCollection):
+        if self._store_path:
+            return self._computed(TweetCount())
+        if self._assume_sorted and isinstance(self._collection, mongo_tweet_collection.MongoTweetCollection):
             return self.grouped_result(lambda it: pd.Series(it.count(), index=['count']))
-        else:
-            return self.grouped_result(lambda it: pd.Series(sum(1 for e in it), index=['count']))
+        res = self._bucket_key_counts(lambda tweet: 0, 1)
+        res.columns = ['count']
+        return res
+
+    def unique_users(self, approximate=False, precision=14):
+        if not self._assume_sorted:
+            return self._computed(UniqueUsers(approximate, precision))
+        return self.grouped_result(_unique_users, approximate=approximate, precision=precision)
+
+    def unique_user_sketches(self, precision=14):
+        """
+        Returns a Series of HyperLogLog sketches of the user ids in each time slice.
+        Sketches can be rolled up to coarser periods without reading the tweets again.
 
-    def unique_users(self):
-        return self.grouped_result(_unique_users)
+        Example:
+        ########
+        from smapp_toolkit.twitter.sketches import rollup_sketches
+        daily = collection.group_by('days').unique_user_sketches()
+        daily.map(len)                          # daily unique users
+        rollup_sketches(daily, 'W').map(len)    # weekly unique users
+        """
+        plan = {'users': UniqueUsers(approximate=True, precision=precision)}
+        sketches = dict((t, states['users']) for t, states in self._plan_states(plan))
+        return pd.Series(sketches).sort_index()
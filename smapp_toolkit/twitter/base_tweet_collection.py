@@ -1,23 +1,59 @@
 # encoding: utf-8
 import re
-import gzip
+import os
+import copy
 import pandas as pd
 import figure_makers
 import figure_helpers
-import networkx as nx
-from bson import BSON
+from bson import json_util
 from aggregator import Aggregator
+from columns import _recursive_read, _make_row, _compile_column, _compile_row
+from exporters import ParallelGzipWriter, BatchedCSVWriter, CSVLines, PartitionedFiles, RAW_BUFFER_SIZE
+from compact_ids import IdCounter
+from cache import ResultCache, cached_result
+from labeling import LabelMatcher, label_in_parallel
+from networks import UserNetwork, ExternalNetwork, _metadata, _metadata_readers
+from aggregates import make_plan, run_plan, plan_results, FEATURES
 from abc import ABCMeta, abstractmethod
 from smappPy.iter_util import get_ngrams
-from collections import Counter, defaultdict
-from smappPy.unicode_csv import UnicodeWriter
+from datetime import timedelta
+from collections import defaultdict, OrderedDict
 from smappPy.retweet import is_official_retweet
 from smappPy.text_clean import get_cleaned_tokens
-from smappPy.xml_util import clear_unicode_control_chars
 from smappPy.store_tweets import tweets_to_bson, tweets_to_json
 from counter_functions import _top_user_locations, _top_ngrams, _top_unigrams, _top_bigrams, \
     _top_trigrams, _top_links, _top_urls, _top_images, _top_hashtags, _top_mentions, \
-    _top_geolocation_names, _language_counts, _top_entities, _unique_users
+    _top_geolocation_names, _language_counts, _top_entities, _unique_users, _term_counts
+
+_TIME_PARTITIONS = {'hours': '%Y-%m-%d-%H', 'days': '%Y-%m-%d', 'months': '%Y-%m', 'years': '%Y'}
+
+def _partition_function(key):
+    """
+    Returns a function of a tweet that returns the (distinct, non-empty) names of the
+    partitions it belongs to, for a `key` of `dump_partitioned()`.
+    """
+    if callable(key):
+        values = key
+    elif key in _TIME_PARTITIONS:
+        time_format = _TIME_PARTITIONS[key]
+        values = lambda tweet: tweet['timestamp'].strftime(time_format)
+    elif key == 'weeks':
+        values = lambda tweet: (tweet['timestamp'].date() - timedelta(days=tweet['timestamp'].weekday())).isoformat()
+    elif key in FEATURES:
+        values = FEATURES[key]
+    else:
+        values = _compile_column(key, raw=True)
+    def partitions(tweet):
+        ret = values(tweet)
+        if not isinstance(ret, (list, tuple, set)):
+            ret = [ret]
+        return set(unicode(value).replace(os.sep, '_') for value in ret if value is not None and value != '')
+    return partitions
+
+def _text_or_none(value):
+    if value is None or isinstance(value, basestring):
+        return value
+    return unicode(value)
 
 class BaseTweetCollection(object):
     __metaclass__ = ABCMeta
@@ -71,6 +107,40 @@ class BaseTweetCollection(object):
         """
         return self.field_containing('user.location', *names)
 
+    def cached(self, directory, max_bytes=1024**3, ttl=15 * 60):
+        """
+        Returns a copy of the collection whose results (top_x(), count(), compute(), ...) are
+        cached on disk in `directory`, for at most `max_bytes`. Collections derived from it
+        with filters share the cache. See `cache.ResultCache` for when results expire.
+
+        Example:
+        ########
+        col = collection.cached('/home/smapp/cache')
+        col.since(datetime(2015,6,1)).until(datetime(2015,6,2)).containing('x').top_hashtags()
+        """
+        ret = copy.copy(self)
+        ret._result_cache = ResultCache(directory, max_bytes, ttl)
+        return ret
+
+    def _cache_identity(self):
+        """
+        What identifies the data behind the collection, beyond `_describe()`.
+        """
+        return None
+
+    def _results_are_final(self):
+        """
+        Whether results over this collection can no longer change.
+        """
+        return False
+
+    def throughput(self):
+        """
+        Returns the read-ahead throughput counter (a `ReadAheadStats`) of a collection
+        created with `read_ahead()`, or None if read-ahead is not enabled.
+        """
+        return self._read_ahead_stats
+
     def texts(self):
         """
         Return the tweet texts matching all specified criteria.
@@ -82,7 +152,7 @@ class BaseTweetCollection(object):
         """
         return [tweet['text'] for tweet in self]
 
-    def group_by(self, time_unit):
+    def group_by(self, time_unit, assume_sorted=True, workers=None):
         """
         Get results by time slice ('days', 'hours', 'minutes', 'seconds').
         Returns a generator of times and tweet-generators, like this:
@@ -108,52 +178,46 @@ class BaseTweetCollection(object):
         # 2015-06-3      14           1           5       NaN   4
         # 2015-06-4      17           1           5         1   6
         # 2015-06-5      10           3           3         3   3
+
+        ---------------------------------------------------
+
+        Time slices assume the collection is sorted by timestamp. For collections in any
+        order (e.g. stream captures), `assume_sorted=False` assigns each tweet to its time
+        slice in a single pass. Only the top_x(), count(), language_counts(), unique_users()
+        and compute() methods work in that mode.
+
+        Example:
+        ########
+        collection.group_by('hours', assume_sorted=False).top_hashtags(n=5)
+
+        ---------------------------------------------------
+
+        On a MongoTweetCollection, `workers` runs that many time slice queries at once.
+
+        Example:
+        ########
+        collection.since(datetime(2015,6,1)).until(datetime(2015,7,1)).group_by('hours', workers=8).top_hashtags(n=5)
         """
-        return Aggregator(self, time_unit=time_unit)
+        return Aggregator(self, time_unit=time_unit, assume_sorted=assume_sorted, workers=workers)
 
 
-    def apply_labels(self, list_of_labels, list_of_fields, list_for_values, bsonoutputpath):
+    def apply_labels(self, list_of_labels, list_of_fields, list_for_values, bsonoutputpath, workers=None):
         '''
         This method applies labels chosen by the user to collection objects.
         Read the docs in the README.md to see how it works
+        Tweets that are not labeled are copied without being re-encoded.
+        The rules are compiled once (see `labeling.LabelMatcher`). A BSON collection
+        can be labeled by `workers` processes, each labeling a part of the file.
+        Returns a dict with the number of 'matched' and 'unmatched' tweets.
         '''
-        filehandle = open(bsonoutputpath, 'wb+')
-        for tweet in self:
-            tweet_should_be_labeled = 0
-            ##for each field in the list of fields we're looking for
-            for i, each_field in enumerate(list_of_fields):
-                ##split the field names so that user.id becomes user id
-                split_field = each_field.split('.')
-                tweet_ref = tweet
-                ## take "user" and "id" and navigate into the structure of the tweet
-                for field_level in split_field: 
-                    tweet_ref = tweet_ref[field_level]
-                ## if the value we want to match is equal to the field or a substring of the field
-                ## (text and user description) match it
-                try:
-                    for list_value in list_for_values[i]:
-                        if tweet_ref and list_value in tweet_ref: 
-                            tweet_should_be_labeled = 1
-                except Exception as e:
-                    print "tweet_ref that threw error {}".format(tweet_ref)
-                    print "Error for a certain field {}, trying non iterable...".format(e)
-                    try:
-                        if tweet_ref in list_for_values[i]:
-                            tweet_should_be_labeled = 1
-                    except Exception as e:
-                        print "Non iterable method also failed, this one can't be labeled: {}".format(e)
-            if tweet_should_be_labeled:
-                tweet['labels']= {}
-                ##add the labels to the tweet objects##
-                for i, label_name in enumerate(list_of_labels[0]):
-                    tweet['labels'][str(i)] = {}
-                    tweet['labels'][str(i)]['name'] = list_of_labels[0][i]
-                    tweet['labels'][str(i)]['type']= list_of_labels[1][i]
-            filehandle.write(BSON.encode(tweet)) 
-        ##close the file handle##
-        filehandle.close()
+        matcher = LabelMatcher(list_of_labels, list_of_fields, list_for_values)
+        if workers > 1 and hasattr(self, '_document_ranges') and not self._limit:
+            return label_in_parallel(self, matcher, bsonoutputpath, workers, RAW_BUFFER_SIZE)
+        with open(bsonoutputpath, 'wb+', RAW_BUFFER_SIZE) as filehandle:
+            return matcher.label(self._raw_tweets(), filehandle)
 
-    def top_unigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
+    @cached_result
+    def top_unigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
         """
         Return the top 'n' unigrams (tokenized words) in the collection.
         Warning: may take a while, as it has to iterate over all tweets in collection.
@@ -174,19 +238,27 @@ class BaseTweetCollection(object):
         'stopwords' can be a list of words to remove from each tweet before considering.
         Seel nltk (http://www.nltk.org/book/ch02.html) stopwords corpuses, for example.
 
+        'capacity' bounds memory for large collections: instead of counting every n-gram
+        exactly, at most 2 * capacity counters are kept (see `sketches.FrequentItems`).
+        Counts are then lower bounds, off by at most (number of n-grams) / (capacity + 1),
+        and any n-gram more frequent than that is guaranteed to be counted.
+
         Example (get top 100 unigrams, removing english stopwords from consideration):
         ##############################################################################
         import nltk
         collection.top_unigrams(n=100, stopwords=nltk.stopwords.words("english"))
         """
-        return _top_unigrams(self, n, hashtags, mentions, rts, mts, https, stopwords)
+        return _top_unigrams(self, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
-    def top_bigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-        return _top_bigrams(self, n, hashtags, mentions, rts, mts, https, stopwords)
+    @cached_result
+    def top_bigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
+        return _top_bigrams(self, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
-    def top_trigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-        return _top_trigrams(self, n, hashtags, mentions, rts, mts, https, stopwords)
+    @cached_result
+    def top_trigrams(self, n=10, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
+        return _top_trigrams(self, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
+    @cached_result
     def top_links(self, n=10):
         """
         Returns a list of tuples representing the top 'n' links (default: 10) in the
@@ -197,24 +269,34 @@ class BaseTweetCollection(object):
         """
         return _top_links(self, n)
 
-    def top_urls(self, n=10):
+    @cached_result
+    def top_urls(self, n=10, capacity=None):
         """
         See 'top_links()'. Same, but for only embedded links (not Tweet Media).
+        'capacity' approximates counts in bounded memory, see 'top_unigrams()'.
         """
-        return _top_urls(self, n)
+        return _top_urls(self, n, capacity)
 
+    @cached_result
     def top_images(self, n=10):
         return _top_images(self, n)
 
-    def top_hashtags(self, n=10):
-        return _top_hashtags(self, n)
+    @cached_result
+    def top_hashtags(self, n=10, capacity=None):
+        """
+        Returns the top 'n' hashtags (lowercased).
+        'capacity' approximates counts in bounded memory, see 'top_unigrams()'.
+        """
+        return _top_hashtags(self, n, capacity)
 
+    @cached_result
     def top_mentions(self, n=10):
         """
         Same as other top functions, except returns the number of unique (user_id, user_screen_name) pairs.
         """
         return _top_mentions(self, n)
 
+    @cached_result
     def top_user_locations(self, n=10, count_each_user_once=True):
         """
         Return top user location strings.
@@ -225,6 +307,7 @@ class BaseTweetCollection(object):
         """
         return _top_user_locations(self, n, count_each_user_once)
 
+    @cached_result
     def top_geolocation_names(self, n=10):
         """
         Return top location names from geotagged tweets. Place names come from twitter's "Places".
@@ -232,24 +315,49 @@ class BaseTweetCollection(object):
         return _top_geolocation_names(self, n)
 
     DEFAULT_RT_COLUMNS = ['user.screen_name', 'created_at', 'text']
-    def top_retweets(self, n=10, rt_columns=DEFAULT_RT_COLUMNS):
+    @cached_result
+    def top_retweets(self, n=10, rt_columns=DEFAULT_RT_COLUMNS, refetch=False):
         """
         Returns a list of top retweets as a pandas DataFrame.
         Columns to include in the dataframe from the original retweet are passed in `rt_columns`.
         The default `rt_columns=['user.screen_name', 'created_at', 'text']`
 
+        Retweet counts are kept in a compact IdCounter, and only `rt_columns` of each
+        original tweet are kept. If `refetch` is True, only the ids are kept, and the
+        top n originals are read again in a second pass over the collection.
+
         Example:
         ########
         col.top_retweets(rt_columns=['timestamp', 'text'])
         """
-        rt_dict = {}
-        rt_counts = Counter()
+        rt_rows = {}
+        rt_counts = IdCounter()
         for tweet in self:
             if is_official_retweet(tweet):
-                rt_dict[tweet["retweeted_status"]["id"]] = tweet["retweeted_status"]
-                rt_counts[tweet["retweeted_status"]["id"]] += 1
-        return pd.DataFrame([[tid, tcount] + self._make_row(rt_dict[tid], rt_columns) for tid, tcount in rt_counts.most_common(n)], columns=['id', 'count']+rt_columns)
+                tid = tweet["retweeted_status"]["id"]
+                rt_counts.add(tid)
+                if not refetch and tid not in rt_rows:
+                    rt_rows[tid] = tuple(_make_row(tweet["retweeted_status"], rt_columns))
+        top = rt_counts.most_common(n)
+        if refetch:
+            rt_rows = self._retweeted_rows(set(winner for winner, _ in top), rt_columns)
+        return pd.DataFrame([[tid, tcount] + list(rt_rows[tid]) for tid, tcount in top], columns=['id', 'count']+rt_columns)
 
+    def _retweeted_rows(self, ids, rt_columns):
+        """
+        Returns a dict of tweet id -> `rt_columns` of the original tweet, for the retweeted tweets in `ids`.
+        """
+        rows = {}
+        for tweet in self:
+            if is_official_retweet(tweet):
+                tid = tweet["retweeted_status"]["id"]
+                if tid in ids and tid not in rows:
+                    rows[tid] = _make_row(tweet["retweeted_status"], rt_columns)
+                    if len(rows) == len(ids):
+                        break
+        return rows
+
+    @cached_result
     def top_entities(self, n=10, urls=True, images=True, hts=True, mentions=True, geolocation_names=True, user_locations=True, ngrams=(1,2),
         ngram_stopwords=[], ngram_hashtags=True, ngram_mentions=True, ngram_rts=False, ngram_mts=False, ngram_https=False):
         """
@@ -284,11 +392,15 @@ class BaseTweetCollection(object):
             ngram_rts=ngram_rts, ngram_mts=ngram_mts, ngram_https=ngram_https)
 
 
-    def term_counts(self, terms, count_by='days', plot=False, plot_total=True, match='tokens', case_sensitive=False):
+    def term_counts(self, terms, count_by='days', plot=False, plot_total=True, match='tokens', case_sensitive=False,
+        as_dataframe=False):
         """
         Returns a dict with term counts aggregated by `count_by`. Acceptable values for `count_by` are 'days', 'hours', 'minutes'.
         if `plot` is True, also plots a histogram.
 
+        If `as_dataframe` is True, returns a DataFrame indexed by time instead, with a
+        column per term and a '_total' column.
+
         Example:
         ########
         collection.term_counts(['justin', 'miley'])
@@ -304,62 +416,66 @@ class BaseTweetCollection(object):
         else:
             raise Exception("Illegal value for `count_by` ({}). Legal values are ['days', 'hours', 'minutes'].".format(count_by))
 
-        if not case_sensitive:
-            terms = [t.lower() for t in terms]
-
-        _DEFAULT_COUNTS_TOKENIZER_REGEXP = re.compile('\w+')
-        _DEFAULT_COUNTS_TOKENIZER = lambda s: _DEFAULT_COUNTS_TOKENIZER_REGEXP.findall(s)
-        if match == 'tokens' and case_sensitive:
-            contains = lambda text, term: term in _DEFAULT_COUNTS_TOKENIZER(text)
-        elif match == 'tokens' and not case_sensitive:
-            contains = lambda text, term: term in _DEFAULT_COUNTS_TOKENIZER(text.lower())
-        elif match == 'substring' and case_sensitive:
-            contains = lambda text, term: term in text
-        elif match == 'substring' and not case_sensitive:
-            contains = lambda text, term: term in text.lower()
-        else:
-            raise Exception("Illegal value for `match`. Legal values are ['tokens', 'substring'].")
-
-        ret = defaultdict(lambda: {t: 0 for t in terms+['_total']})
+        frame = _term_counts(self.containing(*terms), terms, count_by, match, case_sensitive)
 
-        for tweet in self.containing(*terms):
-            d = ret[tweet['timestamp'].strftime(KEY_FORMAT)]
-            d['_total'] += 1
-            for term in terms:
-                if contains(tweet['text'], term):
-                    d[term] += 1
+        columns = list(frame.columns)
+        ret = defaultdict(lambda: {t: 0 for t in columns})
+        for t, row in zip(frame.index, frame.values.tolist()):
+            ret[t.strftime(KEY_FORMAT)] = dict(zip(columns, row))
 
         if plot:
             figure_helpers.term_counts_histogram(ret, KEY_FORMAT, count_by, plot_total)
 
+        if as_dataframe:
+            return frame
         return ret
 
+    @cached_result
+    def compute(self, *names, **aggregates):
+        """
+        Computes several aggregates in a single pass over the collection.
+        Aggregates are given by name (computed with default arguments), or as keyword
+        arguments with `Aggregate` objects from `smapp_toolkit.twitter.aggregates`.
+        Returns a dict with the result of each aggregate.
+
+        Known names are 'count', 'unique_users', 'language_counts', 'top_hashtags',
+        'top_mentions', 'top_urls', 'top_links', 'top_images', 'top_geolocation_names',
+        'top_user_locations', 'top_unigrams', 'top_bigrams', 'top_trigrams', 'top_retweets'.
+
+        Example:
+        ########
+        from smapp_toolkit.twitter.aggregates import TopHashtags, LanguageCounts, CountBy
+
+        results = collection.compute('top_mentions', 'unique_users',
+                                     hashtags=TopHashtags(n=20),
+                                     langs=LanguageCounts(['en', 'es', 'other']),
+                                     sources=CountBy(lambda tweet: [tweet['source']]))
+        results['hashtags']
+        """
+        plan = make_plan(names, aggregates)
+        return plan_results(plan, run_plan(plan, self))
+
+    @cached_result
     def language_counts(self, langs=['en', 'other']):
         return _language_counts(self, langs)
 
-    def unique_users(self):
-        return _unique_users(self)
+    @cached_result
+    def unique_users(self, approximate=False, precision=14):
+        """
+        Returns the number of distinct users in the collection.
+
+        If `approximate` is True, users are counted with a HyperLogLog sketch of
+        2 ** `precision` bytes instead of a set of all user ids. The standard error
+        is 1.04 / sqrt(2 ** `precision`), about 0.8% for the default precision.
+        """
+        return _unique_users(self, approximate, precision)
 
     def _recursive_read(self, tweet, col_name):
-        path = col_name.split('.')
-        try:
-            value = tweet[path.pop(0)]
-            for p in path:
-                if isinstance(value, list):
-                    value = value[int(p)]
-                else:
-                    value = value[p]
-        except:
-            value = ''
-        return unicode(value)
+        return _recursive_read(tweet, col_name)
 
     DEFAULT_CSV_COLUMNS = ['id_str', 'user.screen_name', 'timestamp', 'text']
     def _make_row(self, tweet, columns=DEFAULT_CSV_COLUMNS):
-        row = list()
-        for col_name in columns:
-            value = self._recursive_read(tweet, col_name)
-            row.append(u','.join(unicode(v) for v in value) if isinstance(value, list) else unicode(value))
-        return row
+        return _make_row(tweet, columns)
 
 
     def dump_bson_to_path (self, bsonoutputpath):
@@ -369,14 +485,15 @@ class BaseTweetCollection(object):
         this function actually dumps BSON (a binary format)
         whereas the method below dumps json formatted BSON 
         in a spaghetti string with no commas.
+        Tweets are copied as they are stored, without being decoded and re-encoded.
         '''
-        filehandle = open(bsonoutputpath, 'ab+')
-        for tweet in self:
-            filehandle.write(BSON.encode(tweet))
+        filehandle = open(bsonoutputpath, 'ab+', RAW_BUFFER_SIZE)
+        for data in self._raw_documents():
+            filehandle.write(data)
         filehandle.close()
 
 
-    def dump_csv(self, filename, columns=DEFAULT_CSV_COLUMNS):
+    def dump_csv(self, filename, columns=DEFAULT_CSV_COLUMNS, batch_size=10000, compress_workers=None):
         """
         Dumps the matching tweets to a CSV file specified by `filename`.
         The default columns are ['id_str', 'user.screen_name', 'timestamp', 'text'].
@@ -385,23 +502,201 @@ class BaseTweetCollection(object):
 
         If `filename` ends with `.gz`, it will be a gzipped file. Else it will be a plaintext (utf8) file.
         Gzip typically achieves 3x-5x compression on this type of data, depending on the columns chosen and the structure of the data.
+        The gzipped file is compressed in blocks on `compress_workers` threads (default: one per CPU).
+
+        Rows are encoded `batch_size` at a time before they are written.
 
         Example:
         ########
         collection.since(one_hour_ago).dump_csv('my_tweets.csv', columns=['timestamp', 'text'])
         """
         if filename.endswith('.gz'):
-            outfile = gzip.open(filename, 'w')
+            outfile = ParallelGzipWriter(filename, workers=compress_workers)
         else:
-            outfile = open(filename, 'w')
+            outfile = open(filename, 'wb')
         try:
-            writer = UnicodeWriter(outfile)
+            writer = BatchedCSVWriter(outfile, batch_size)
             writer.writerow(columns)
+            make_row = _compile_row(columns)
             for tweet in self:
-                writer.writerow(self._make_row(tweet, columns))
+                writer.writerow(make_row(tweet))
+            writer.flush()
         finally:
             outfile.close()
 
+    def dump_partitioned(self, path_template, key='days', format=None, columns=DEFAULT_CSV_COLUMNS,
+                         default=None, max_open_files=64):
+        """
+        Dumps the matching tweets to one file per partition in a single pass over the
+        collection. `path_template` is formatted with the name of each partition
+        (e.g. 'tweets_{}.bson').
+
+        `key` is one of 'hours', 'days', 'weeks' (named by their Monday), 'months' or
+        'years' of the tweets' timestamp, one of 'hashtags', 'mentions', 'urls', 'links',
+        'images' or 'geolocation_names' (a tweet is written to the file of each of its
+        values), a field path (e.g. 'lang' or 'user.lang'), or a function of a tweet that
+        returns a partition name or a list of them. Tweets without a partition are
+        written to the `default` partition, or skipped if it is None.
+
+        `format` is 'bson' (tweets are copied as stored), 'json' (one tweet per line)
+        or 'csv' (with `columns`, like `dump_csv`), by default the extension of
+        `path_template`. At most `max_open_files` files are open at a time.
+
+        Returns a dict of partition name -> file path.
+
+        Example:
+        ########
+        collection.dump_partitioned('/data/tweets_{}.bson', key='days')
+        collection.dump_partitioned('/data/tweets_{}.csv', key='lang', columns=['id_str', 'text'])
+        """
+        if format is None:
+            format = os.path.splitext(path_template)[1].lstrip('.')
+        if format not in ('bson', 'json', 'csv'):
+            raise ValueError("Illegal format ({}). Legal values are 'bson', 'json' and 'csv'.".format(format))
+        partitions_of = _partition_function(key)
+        header = ''
+        if format == 'csv':
+            lines = CSVLines()
+            make_row = _compile_row(columns)
+            header = lines.encode(columns)
+        if format == 'bson':
+            tweets = self._raw_tweets()
+        else:
+            tweets = ((tweet, None) for tweet in self)
+        with PartitionedFiles(path_template, max_open_files, header=header) as files:
+            for tweet, data in tweets:
+                partitions = partitions_of(tweet)
+                if not partitions:
+                    if default is None:
+                        continue
+                    partitions = [default]
+                if format == 'json':
+                    data = json_util.dumps(tweet) + '\n'
+                elif format == 'csv':
+                    data = lines.encode(make_row(tweet))
+                for partition in partitions:
+                    files.write(partition, data)
+        return {partition: files.path(partition) for partition in files.partitions()}
+
+    DEFAULT_DATAFRAME_COLUMNS = ['id', 'user.id', 'user.screen_name', 'user.location', 'timestamp', 'lang', 'text']
+    CATEGORICAL_COLUMNS = ['lang', 'user.lang', 'user.location', 'user.time_zone', 'place.full_name',
+                           'place.country', 'place.country_code', 'source']
+    def to_dataframes(self, columns=DEFAULT_DATAFRAME_COLUMNS, chunksize=100000, categories=CATEGORICAL_COLUMNS):
+        """
+        Returns a generator of pandas DataFrames of at most `chunksize` matching tweets each,
+        with a column per path in `columns` (like `dump_csv`). Values keep their types:
+        ids are int64 (object columns of ints and None in chunks where some are missing,
+        so that they are never rounded to floats), 'timestamp' is a datetime64 column,
+        and the `categories` columns (lang, user location, ...) are categoricals. Other
+        missing values are None/NaN/NaT.
+
+        Example:
+        ########
+        for df in collection.to_dataframes(['id', 'timestamp', 'lang', 'text'], chunksize=50000):
+            df.groupby('lang').size()
+        """
+        readers = [_compile_column(col_name, raw=True) for col_name in columns]
+        chunk = [list() for _ in columns]
+        rows = 0
+        for tweet in self:
+            for values, read in zip(chunk, readers):
+                values.append(read(tweet))
+            rows += 1
+            if rows >= chunksize:
+                yield self._typed_dataframe(columns, chunk, categories)
+                chunk = [list() for _ in columns]
+                rows = 0
+        if rows:
+            yield self._typed_dataframe(columns, chunk, categories)
+
+    def _typed_dataframe(self, columns, chunk, categories):
+        data = OrderedDict()
+        for col_name, values in zip(columns, chunk):
+            if self._integer_values(values):
+                # 18 digit ids don't survive pandas' upcast to float64 when a value is missing
+                dtype = object if None in values else 'int64'
+                data[col_name] = pd.Series(values, dtype=dtype)
+            else:
+                data[col_name] = values
+        df = pd.DataFrame(data, columns=columns)
+        for col_name in columns:
+            if self._timestamp_column(col_name):
+                df[col_name] = pd.to_datetime(df[col_name])
+            elif col_name in categories:
+                df[col_name] = df[col_name].astype('category')
+        return df
+
+    def _integer_values(self, values):
+        found = False
+        for value in values:
+            if value is None:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, long)):
+                return False
+            found = True
+        return found
+
+    def _timestamp_column(self, col_name):
+        return col_name == 'timestamp' or col_name.endswith('.timestamp')
+
+    INTEGER_FIELDS = ['id', 'in_reply_to_status_id', 'in_reply_to_user_id', 'quoted_status_id', 'retweet_count',
+                      'favorite_count', 'followers_count', 'friends_count', 'statuses_count', 'listed_count',
+                      'favourites_count']
+    def _parquet_schema(self, pa, df):
+        """
+        Schema of the Parquet file, from its first DataFrame: known integer fields are
+        int64 and timestamps are in microseconds even if the first chunk has no value
+        for them, and other columns without a value are strings.
+        """
+        fields = list()
+        for field in pa.Schema.from_pandas(df, preserve_index=False):
+            parts = field.name.split('.')
+            if self._timestamp_column(field.name):
+                field = pa.field(field.name, pa.timestamp('us'))
+            elif parts[-1] in self.INTEGER_FIELDS and parts[-2:-1] != ['place'] and field.type in (pa.int64(), pa.null()):
+                field = pa.field(field.name, pa.int64())
+            elif field.type == pa.null():
+                field = pa.field(field.name, pa.string())
+            fields.append(field)
+        return pa.schema(fields)
+
+    def dump_parquet(self, path, columns=DEFAULT_DATAFRAME_COLUMNS, row_group_size=100000, compression='snappy'):
+        """
+        Dumps the matching tweets to a Parquet file at `path`, with the columns of
+        `to_dataframes()`, one row group per `row_group_size` tweets. Parquet files are
+        columnar and compressed: `pd.read_parquet(path, columns=['timestamp', 'lang'])`
+        only reads the columns it needs. Categorical columns are stored as (dictionary
+        encoded) strings, ids and counts as int64 and timestamps in microseconds, even when
+        the first row group has no value for them. Requires the `pyarrow` package.
+
+        Example:
+        ########
+        collection.dump_parquet('tweets.parquet', columns=['id', 'timestamp', 'lang', 'user.location', 'text'])
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("dump_parquet requires pyarrow (pip install pyarrow)")
+        writer = None
+        try:
+            for df in self.to_dataframes(columns, row_group_size):
+                for col_name in df.columns:
+                    if df[col_name].dtype.name == 'category':
+                        df[col_name] = df[col_name].astype(object)
+                if writer is None:
+                    schema = self._parquet_schema(pa, df)
+                    writer = pq.ParquetWriter(path, schema, compression=compression,
+                                              coerce_timestamps='us', allow_truncated_timestamps=True)
+                for field in schema:
+                    if field.type == pa.string():
+                        df[field.name] = df[field.name].map(_text_or_none)
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                writer.write_table(table, row_group_size=row_group_size)
+        finally:
+            if writer is not None:
+                writer.close()
+
     def dump_json(self, filename, append=False, pretty=False):
         """
         Dumps the matching tweets in raw Mongo JSON (default) or Pure JSON (pure_json=True)
@@ -418,43 +713,117 @@ class BaseTweetCollection(object):
         tweets_to_bson(self, filename, append)
 
     def _make_metadata_dict(self, obj, fields):
-        return { field: clear_unicode_control_chars(self._recursive_read(obj, field))\
-         for field in fields }
+        return _metadata(obj, _metadata_readers(fields))
 
     def retweet_network(
         self,
         user_metadata=['id_str', 'screen_name', 'location', 'description'],
-        tweet_metadata=['id_str', 'retweeted_status.id_str', 'timestamp', 'text', 'lang']):
+        tweet_metadata=['id_str', 'retweeted_status.id_str', 'timestamp', 'text', 'lang'],
+        output='networkx'):
         """
         Generate a retweet graph from the selection of tweets.
         Users are nodes, retweets are directed links.
 
         `user_metadata` is a list of fields from the User object that will be included as
-        attributes in the nodes.
+        attributes in the nodes (read the first time each user is seen).
         `tweet_metadata` is a list of the fields from the Tweet object that will be included
-        as attributes on the edges.
+        as attributes on the edges (read from the first retweet of each edge).
+        Repeated retweets between two users are a single edge, whose 'weight' is their number.
 
         If the collection result includes non-retweets as well, users with no retweets
         will also appear in the graph as isolated nodes. Only retweets are edges in the
         resulting graph.
 
+        `output` is 'networkx' (a DiGraph), 'sparse' (a SciPy sparse adjacency matrix, with
+        nodes in the order of the network's `node_ids`) or 'network' (the `networks.UserNetwork`,
+        which can also return edge arrays).
+
         Example:
         ########
-        imprt networkx as nx
+        import networkx as nx
         digraph = collection.containing('#AnyoneButHillary').only_retweets().retweet_network()
         nx.write_graphml(digraph, '/path/to/outputfile.graphml')
         """
-        dg = nx.DiGraph(name=u"RT graph of {}".format(unicode(self)))
+        if output not in ('networkx', 'sparse', 'network'):
+            raise ValueError("Illegal output ({}). Legal values are 'networkx', 'sparse' and 'network'.".format(output))
+        network = UserNetwork(user_metadata, tweet_metadata, name=u"RT graph of {}".format(unicode(self)))
         for tweet in self:
-            user = tweet['user']
-            if user['id_str'] not in dg:
-                dg.add_node(tweet['user']['id_str'],
-                    attr_dict=self._make_metadata_dict(user, user_metadata))
             if 'retweeted_status' in tweet:
-                retweeted_user = tweet['retweeted_status']['user']
-                dg.add_node(retweeted_user['id_str'],
-                    attr_dict=self._make_metadata_dict(retweeted_user, user_metadata))
-                dg.add_edge(user['id_str'], retweeted_user['id_str'],
-                    attr_dict=self._make_metadata_dict(tweet, tweet_metadata))
-        return dg
+                network.add_edge(tweet['user'], tweet['retweeted_status']['user'], tweet)
+            else:
+                network.add_user(tweet['user'])
+        if output == 'network':
+            return network
+        if output == 'sparse':
+            return network.to_sparse()
+        return network.to_networkx()
+
+    def mention_network(self, path, user_metadata=['id_str', 'screen_name', 'location', 'description'],
+                        format=None, nodes_path=None, chunk_size=1000000, temp_dir=None):
+        """
+        Writes the mention graph of the selection of tweets to `path`, as GraphML or CSV.
+        Users are nodes, and there is an edge from the author of each tweet to each user
+        it mentions, weighted by the number of such mentions. Authors who mention no one
+        are isolated nodes.
+
+        The graph is never held in memory: edges and nodes are sorted in chunks of
+        `chunk_size` into files in `temp_dir` (default: the system's temporary directory),
+        which are merged as the output is written (see `networks.ExternalNetwork`).
+
+        `user_metadata` fields are attributes of the nodes. Mentioned users who never
+        authored a tweet of the selection only have an 'id_str' and a 'screen_name'.
+        `format` is 'graphml' or 'csv', by default the extension of `path`. CSV graphs are
+        an edge list (source, target, weight) at `path` and a node list at `nodes_path`
+        (default: `path` with '_nodes' before its extension).
+
+        Returns a dict with the number of 'nodes' and 'edges' written.
+
+        Example:
+        ########
+        collection.since(datetime(2015,1,1)).mention_network('/path/to/mentions.graphml', user_metadata=['screen_name'])
+        """
+        def mentioned_users(tweet):
+            return (tweet.get('entities') or {}).get('user_mentions') or []
+        return self._external_network(mentioned_users, path, user_metadata, format, nodes_path, chunk_size, temp_dir,
+                                      u"Mention graph of {}".format(unicode(self)))
+
+    def reply_network(self, path, user_metadata=['id_str', 'screen_name', 'location', 'description'],
+                      format=None, nodes_path=None, chunk_size=1000000, temp_dir=None):
+        """
+        Writes the reply graph of the selection of tweets to `path`, as GraphML or CSV.
+        Users are nodes, and there is an edge from the author of each reply to the user
+        it replies to, weighted by the number of replies. Works like `mention_network()`.
+
+        Example:
+        ########
+        collection.reply_network('/path/to/replies.csv')
+        """
+        def replied_users(tweet):
+            if tweet.get('in_reply_to_user_id') is None:
+                return []
+            return [{'id': tweet['in_reply_to_user_id'],
+                     'id_str': tweet.get('in_reply_to_user_id_str') or unicode(tweet['in_reply_to_user_id']),
+                     'screen_name': tweet.get('in_reply_to_screen_name') or u''}]
+        return self._external_network(replied_users, path, user_metadata, format, nodes_path, chunk_size, temp_dir,
+                                      u"Reply graph of {}".format(unicode(self)))
+
+    def _external_network(self, targets_of, path, user_metadata, format, nodes_path, chunk_size, temp_dir, name):
+        if format is None:
+            format = os.path.splitext(path)[1].lstrip('.')
+        if format not in ('graphml', 'csv'):
+            raise ValueError("Illegal format ({}). Legal values are 'graphml' and 'csv'.".format(format))
+        network = ExternalNetwork(user_metadata, chunk_size, temp_dir, name)
+        try:
+            for tweet in self:
+                network.add_user(tweet['user'])
+                for target in targets_of(tweet):
+                    network.add_edge(tweet['user'], target, target_priority=1)
+            if format == 'graphml':
+                return network.write_graphml(path)
+            if nodes_path is None:
+                root, extension = os.path.splitext(path)
+                nodes_path = root + '_nodes' + extension
+            return network.write_csv(path, nodes_path)
+        finally:
+            network.close()
 
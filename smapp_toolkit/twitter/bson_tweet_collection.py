@@ -2,11 +2,28 @@ import os
 import re
 import copy
 import pytz
+import struct
+import hashlib
 from random import random
 from datetime import datetime
-from bson import decode_file_iter
+from bson import BSON, decode_file_iter
+from read_ahead import read_ahead, ReadAheadStats
+from cache import cached_result
+from exporters import RAW_BUFFER_SIZE
 from base_tweet_collection import BaseTweetCollection
 
+def _complete_documents_end(data):
+    """
+    Length of the complete BSON documents at the start of `data`.
+    """
+    end = 0
+    while end + 4 <= len(data):
+        size = struct.unpack_from('<i', data, end)[0]
+        if size < 5 or end + size > len(data):
+            break
+        end += size
+    return end
+
 class BSONTweetCollection(BaseTweetCollection):
     """
     Collection object for performing queries and getting data out of a BSON file 
@@ -21,7 +38,10 @@ class BSONTweetCollection(BaseTweetCollection):
         if not os.path.isfile(filename):
             raise IOError("File not found")
         self._filter_functions = list()
+        self._filter_descriptions = list()
         self._limit = None
+        self._read_ahead = None
+        self._read_ahead_stats = None
         for tweet in self:
             break
 
@@ -35,21 +55,172 @@ class BSONTweetCollection(BaseTweetCollection):
             self._filename, len(self._filter_functions), self._limit)
 
     def __iter__(self):
-        with open(self._filename, 'rb') as f:
+        tweets = self._decoded_tweets()
+        if self._read_ahead:
+            tweets = read_ahead(tweets, stats=self._read_ahead_stats, **self._read_ahead)
+        try:
             i = 1
-            for tweet in decode_file_iter(f):
+            for tweet in tweets:
                 if self._limit and i > self._limit:
                     raise StopIteration
                 if all(func(tweet) for func in self._filter_functions):
                     i += 1
                     yield tweet
+        finally:
+            tweets.close()
+
+    def _decoded_tweets(self):
+        with open(self._filename, 'rb') as f:
+            for tweet in decode_file_iter(f):
+                yield tweet
 
-    def _copy_with_added_filter(self, filter_function):
+    def _copy_with_added_filter(self, filter_function, description=None):
+        """
+        `description` is a json-serializable description of the filter, used to fingerprint
+        the collection (see `_describe()`). Filters without one can not be fingerprinted.
+        """
         ret = copy.copy(self)
         ret._filter_functions = copy.copy(self._filter_functions)
         ret._filter_functions.append(filter_function)
+        ret._filter_descriptions = copy.copy(self._filter_descriptions)
+        ret._filter_descriptions.append(description)
         return ret
 
+    def _describe(self):
+        """
+        Description of the file and filters of this collection, used to fingerprint it.
+        """
+        if None in self._filter_descriptions:
+            raise ValueError("Collection has filters that can not be fingerprinted (e.g. sample())")
+        if self._limit is not None:
+            raise ValueError("Collection with a limit can not be fingerprinted")
+        return {'filename': os.path.abspath(self._filename), 'filters': self._filter_descriptions}
+
+    def _cache_identity(self):
+        return {'size': os.path.getsize(self._filename), 'mtime': os.path.getmtime(self._filename)}
+
+    def _results_are_final(self):
+        # the size and modification time of the file are part of the cache key
+        return True
+
+    _HEAD_SIZE = 4096
+
+    def _file_head(self, f, offset):
+        """
+        Hash of the first `_HEAD_SIZE` bytes of `f`, or of its first `offset` bytes if
+        fewer (so that appending to a small file keeps the hash of what was read).
+        """
+        position = f.tell()
+        f.seek(0)
+        head = hashlib.md5(f.read(min(self._HEAD_SIZE, offset))).hexdigest()
+        f.seek(position)
+        return head
+
+    def _is_valid_watermark(self, watermark):
+        """
+        A watermark is valid if the file was only appended to since it was taken.
+        """
+        if watermark is None:
+            return False
+        with open(self._filename, 'rb') as f:
+            return os.path.getsize(self._filename) >= watermark['offset'] and \
+                self._file_head(f, watermark['offset']) == watermark['head']
+
+    def _documents(self, f):
+        """
+        Yields the (end offset, raw bytes) of each complete BSON document of `f`, from its
+        current position. Stops at the end of the file or at a document still being written.
+        """
+        offset = f.tell()
+        while True:
+            size_bytes = f.read(4)
+            if len(size_bytes) < 4:
+                break
+            size = struct.unpack('<i', size_bytes)[0]
+            data = size_bytes + f.read(size - 4)
+            if len(data) < size:
+                break
+            offset += size
+            yield offset, data
+
+    def _tweets_after(self, watermark, progress):
+        """
+        Yields the tweets (matching the filters) stored after `watermark` (the byte offset
+        of the end of the last tweet read, or None to read from the start). As tweets
+        are read, `progress['watermark']` is moved to the end of the last complete one.
+        """
+        with open(self._filename, 'rb') as f:
+            f.seek(watermark['offset'] if watermark else 0)
+            head, hashed = None, None
+            for offset, data in self._documents(f):
+                if min(offset, self._HEAD_SIZE) != hashed:
+                    hashed = min(offset, self._HEAD_SIZE)
+                    head = self._file_head(f, hashed)
+                progress['watermark'] = {'offset': offset, 'head': head}
+                tweet = BSON(data).decode()
+                if all(func(tweet) for func in self._filter_functions):
+                    yield tweet
+
+    def _raw_tweets(self, start=0, end=None):
+        """
+        Yields (tweet, raw BSON bytes) of the matching tweets, of the documents starting
+        between the byte offsets `start` (which must be the start of a document) and `end`.
+        """
+        with open(self._filename, 'rb', RAW_BUFFER_SIZE) as f:
+            f.seek(start)
+            i = 1
+            for offset, data in self._documents(f):
+                if self._limit and i > self._limit:
+                    break
+                if end is not None and offset - len(data) >= end:
+                    break
+                tweet = BSON(data).decode()
+                if all(func(tweet) for func in self._filter_functions):
+                    i += 1
+                    yield tweet, data
+
+    def _document_ranges(self, n):
+        """
+        Splits the file into at most `n` (start, end) byte ranges of about the same size
+        that start and end on document boundaries.
+        """
+        size = os.path.getsize(self._filename)
+        ranges = list()
+        start = offset = 0
+        with open(self._filename, 'rb') as f:
+            for i in range(1, n + 1):
+                target = size * i // n
+                while offset < target:
+                    f.seek(offset)
+                    size_bytes = f.read(4)
+                    if len(size_bytes) < 4:
+                        offset = size
+                        break
+                    offset += struct.unpack('<i', size_bytes)[0]
+                if offset > start:
+                    ranges.append((start, offset))
+                    start = offset
+        return ranges
+
+    def _raw_documents(self):
+        """
+        Yields the raw BSON bytes of the matching tweets (several documents at a time when
+        the whole file matches, in which case it is copied block by block without decoding).
+        Like `_documents`, stops before a document still being written.
+        """
+        if self._filter_functions or self._limit:
+            for _, data in self._raw_tweets():
+                yield data
+        else:
+            with open(self._filename, 'rb') as f:
+                rest = ''
+                for block in iter(lambda: f.read(RAW_BUFFER_SIZE), ''):
+                    data = rest + block if rest else block
+                    end = _complete_documents_end(data)
+                    if end:
+                        yield data[:end]
+                    rest = data[end:]
+
     def matching_regex(self, expr):
         """
         Select tweets where the text matches a regex
@@ -62,7 +233,7 @@ class BSONTweetCollection(BaseTweetCollection):
         ex = re.compile(expr, re.IGNORECASE | re.UNICODE)
         def regex_filter(tweet):
             return ex.search(tweet['text'])
-        return self._copy_with_added_filter(regex_filter)
+        return self._copy_with_added_filter(regex_filter, ['matching_regex', expr])
 
     def field_containing(self, field, *terms):
         """
@@ -79,7 +250,7 @@ class BSONTweetCollection(BaseTweetCollection):
         def field_contains_filter(tweet):
             to_search = self._recursive_read(tweet, field)
             return regex.search(to_search)
-        return self._copy_with_added_filter(field_contains_filter)
+        return self._copy_with_added_filter(field_contains_filter, ['field_containing', field, list(terms)])
 
     def geo_enabled(self):
         """
@@ -89,7 +260,7 @@ class BSONTweetCollection(BaseTweetCollection):
             return "coordinates" in tweet and \
                 tweet["coordinates"] is not None and \
                 "coordinates" in tweet["coordinates"]
-        return self._copy_with_added_filter(geo_enabled_filter)
+        return self._copy_with_added_filter(geo_enabled_filter, ['geo_enabled'])
 
     def non_geo_enabled(self):
         """
@@ -99,7 +270,7 @@ class BSONTweetCollection(BaseTweetCollection):
             return 'coordinates' not in tweet or \
                 tweet['coordinates'] is None or \
                 'coordinates' not in tweet['coordinates']
-        return self._copy_with_added_filter(non_geo_enabled_filter)
+        return self._copy_with_added_filter(non_geo_enabled_filter, ['non_geo_enabled'])
 
     def since(self, since):
         """
@@ -119,7 +290,7 @@ class BSONTweetCollection(BaseTweetCollection):
             # Should this use parsedate(),
             # for cases where we don't have proper 'timestamp's?
             return tweet['timestamp'] > since
-        return self._copy_with_added_filter(since_filter)
+        return self._copy_with_added_filter(since_filter, ['since', since.isoformat()])
 
     def until(self, until):
         """
@@ -139,7 +310,7 @@ class BSONTweetCollection(BaseTweetCollection):
             # Should this use parsedate(),
             # for cases where we don't have proper 'timestamp's?
             return tweet['timestamp'] < until
-        return self._copy_with_added_filter(until_filter)
+        return self._copy_with_added_filter(until_filter, ['until', until.isoformat()])
 
     def language(self, *langs):
         """
@@ -152,7 +323,7 @@ class BSONTweetCollection(BaseTweetCollection):
         """
         def lang_filter(tweet):
             return 'lang' in tweet and tweet['lang'] in langs
-        return self._copy_with_added_filter(lang_filter)
+        return self._copy_with_added_filter(lang_filter, ['language', list(langs)])
 
 
     def excluding_retweets(self):
@@ -161,14 +332,14 @@ class BSONTweetCollection(BaseTweetCollection):
         """
         def excluding_retweets_filter(tweet):
             return 'retweeted_status' not in tweet
-        return self._copy_with_added_filter(excluding_retweets_filter)
+        return self._copy_with_added_filter(excluding_retweets_filter, ['excluding_retweets'])
 
 
     def only_retweets(self):
         "Only return retweets"
         def only_retweets_filter(tweet):
             return 'retweeted_status' in tweet
-        return self._copy_with_added_filter(only_retweets_filter)
+        return self._copy_with_added_filter(only_retweets_filter, ['only_retweets'])
 
     def sample(self, pct):
         """
@@ -198,6 +369,23 @@ class BSONTweetCollection(BaseTweetCollection):
         ret._limit = count
         return ret
 
+    def read_ahead(self, batch_size=1000, queue_size=8):
+        """
+        Read and decode the BSON file in a background thread, handing tweets over in
+        batches of `batch_size`. At most `queue_size` batches are decoded ahead of the
+        consumer. Throughput is reported by `throughput()`.
+
+        Example:
+        ########
+        col = collection.read_ahead(batch_size=5000)
+        col.top_hashtags()
+        col.throughput()
+        """
+        ret = copy.copy(self)
+        ret._read_ahead = {'batch_size': batch_size, 'queue_size': queue_size}
+        ret._read_ahead_stats = ReadAheadStats()
+        return ret
+
     def time_range(self, ):
         """
         Iterates over collection to find timestamp of first and last tweets. Because there
@@ -215,6 +403,7 @@ class BSONTweetCollection(BaseTweetCollection):
     def sort(self, field, direction=1):
         raise NotImplementedError("Sort not implemented for BSON collections (inefficient)")
 
+    @cached_result
     def count(self):
         """
         The count of tweets in the collection matching all specified criteria.
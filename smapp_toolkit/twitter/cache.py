@@ -0,0 +1,134 @@
+"""
+Module contains an opt-in on-disk cache of collection query results.
+
+Results are content addressed: the key is a hash of the backend identity (file path,
+size and modification time, or database and collection names), the filters of the
+collection and the method arguments. Entries are evicted least recently used first
+when the cache grows over its size limit.
+"""
+
+import os
+import time
+import json
+import pickle
+import hashlib
+import functools
+from datetime import datetime, date
+
+
+def _describe_value(value):
+    """
+    json fallback for method arguments: aggregates describe themselves and datetimes are
+    described by their isoformat. Anything else (e.g. a function, whose repr is an address
+    that later functions reuse) raises ValueError, so that the call isn't cached.
+    """
+    if hasattr(value, '_describe'):
+        return [value._describe(), getattr(value, 'n', None)]
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise ValueError("{0!r} can not be fingerprinted".format(value))
+
+
+class ResultCache(object):
+    """
+    On-disk cache of results in `directory`, holding at most `max_bytes` (least recently
+    used entries are evicted first).
+
+    Results over data that can still change (a Mongo collection without an `until()`
+    in the past) expire after `ttl` seconds. Results over a BSON file are keyed by its
+    size and modification time, and results over time ranges entirely in the past never
+    expire; both are only evicted for space.
+
+    Example:
+    ########
+    col = collection.cached('/home/smapp/cache', max_bytes=2 * 1024**3)
+    col.since(a).until(b).containing('x').top_hashtags()   # computed
+    col.since(a).until(b).containing('x').top_hashtags()   # read from the cache
+    """
+    def __init__(self, directory, max_bytes=1024**3, ttl=15 * 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __repr__(self):
+        return "ResultCache({0}, max_bytes={1}, hits={2}, misses={3})".format(
+            self.directory, self.max_bytes, self.hits, self.misses)
+
+    def key(self, collection, method_name, args, kwargs):
+        description = [type(collection).__name__, collection._cache_identity(), collection._describe(),
+                       method_name, list(args), sorted(kwargs.items())]
+        return hashlib.sha1(json.dumps(description, sort_keys=True, default=_describe_value)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get_or_compute(self, collection, method_name, args, kwargs, compute):
+        try:
+            key = self.key(collection, method_name, args, kwargs)
+        except ValueError:
+            # collections with sample() or limit(), and arguments such as functions, can't be fingerprinted
+            return compute()
+        path = self._path(key)
+        entry = self._load(path)
+        if entry is not None and (entry['final'] or time.time() - entry['created'] < self.ttl):
+            self.hits += 1
+            os.utime(path, None)
+            return entry['result']
+        self.misses += 1
+        result = compute()
+        self._store(path, {'created': time.time(), 'final': collection._results_are_final(), 'result': result})
+        return result
+
+    def _load(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _store(self, path, entry):
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = list()
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                os.remove(os.path.join(self.directory, name))
+
+
+def cached_result(method):
+    """
+    Decorator for collection methods whose result can be cached. Calls go through the
+    collection's ResultCache if it has one (see `cached()`), and straight to the method
+    otherwise.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.__dict__.get('_result_cache')
+        if cache is None:
+            return method(self, *args, **kwargs)
+        return cache.get_or_compute(self, method.__name__, args, kwargs, lambda: method(self, *args, **kwargs))
+    return wrapper
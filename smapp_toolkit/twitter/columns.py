@@ -0,0 +1,73 @@
+"""
+Module contains functions to read (possibly nested) columns out of tweets.
+
+Columns are specified by their path in the tweet dictionary, so that
+'user.screen_name' reads tweet['user']['screen_name'] and 'entities.urls.0.url'
+reads the first url.
+"""
+
+def _recursive_read(tweet, col_name):
+    path = col_name.split('.')
+    try:
+        value = tweet[path.pop(0)]
+        for p in path:
+            if isinstance(value, list):
+                value = value[int(p)]
+            else:
+                value = value[p]
+    except:
+        value = ''
+    return unicode(value)
+
+def _make_row(tweet, columns):
+    row = list()
+    for col_name in columns:
+        value = _recursive_read(tweet, col_name)
+        row.append(u','.join(unicode(v) for v in value) if isinstance(value, list) else unicode(value))
+    return row
+
+def _as_index(part):
+    try:
+        return int(part)
+    except ValueError:
+        return None
+
+def _compile_column(col_name, raw=False):
+    """
+    Returns a function of a tweet that reads `col_name` like `_recursive_read`, with the
+    path split and list indices parsed once instead of for every tweet.
+    If `raw` is True, the value is returned as is (None if missing) instead of as unicode.
+    """
+    path = col_name.split('.')
+    first = path[0]
+    rest = [(part, _as_index(part)) for part in path[1:]]
+    missing = None if raw else ''
+    if not rest:
+        def read(tweet):
+            try:
+                value = tweet[first]
+            except:
+                value = missing
+            return value if raw else unicode(value)
+        return read
+    def read(tweet):
+        try:
+            value = tweet[first]
+            for part, index in rest:
+                if isinstance(value, list):
+                    value = value[index]
+                else:
+                    value = value[part]
+        except:
+            value = missing
+        return value if raw else unicode(value)
+    return read
+
+def _compile_row(columns):
+    """
+    Returns a function of a tweet that makes the same row as `_make_row(tweet, columns)`.
+    """
+    readers = [_compile_column(col_name) for col_name in columns]
+    def make_row(tweet):
+        return [read(tweet) for read in readers]
+    return make_row
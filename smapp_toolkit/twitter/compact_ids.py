@@ -0,0 +1,266 @@
+"""
+Module contains compact counters and sets of integer ids (tweet ids, user ids).
+
+New ids are buffered and folded a batch at a time into sorted int64 numpy
+arrays, which take 8 bytes per id (16 with a count) instead of the ~100 bytes
+of a python int in a set or Counter.
+"""
+
+import numpy as np
+
+
+def _merge_sorted_counts(ids, counts, new_ids, new_counts):
+    """
+    Adds `new_counts` of the sorted, distinct `new_ids` to the sorted `ids` and their `counts`.
+    Returns the merged (ids, counts).
+    """
+    positions = np.searchsorted(ids, new_ids)
+    found = positions < len(ids)
+    found[found] = ids[positions[found]] == new_ids[found]
+    counts[positions[found]] += new_counts[found]
+    new = ~found
+    if new.any():
+        ids = np.insert(ids, positions[new], new_ids[new])
+        counts = np.insert(counts, positions[new], new_counts[new])
+    return ids, counts
+
+
+class IdCounter(object):
+    """
+    Exact counter of integer ids. Behaves like a Counter of ids as far as
+    `add`, `update`, `most_common`, `items` and `len` are concerned, and can be
+    merged with other IdCounters.
+    `batch_size` is the number of ids buffered before they are counted with numpy.
+
+    Example:
+    ########
+    retweeted = IdCounter()
+    for tweet in collection:
+        if 'retweeted_status' in tweet:
+            retweeted.add(tweet['retweeted_status']['id'])
+    retweeted.most_common(10)
+    """
+    def __init__(self, batch_size=100000):
+        self.batch_size = batch_size
+        self._pending = list()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, id_):
+        self._pending.append(id_)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def update(self, ids):
+        for id_ in ids:
+            self.add(id_)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        new_ids, new_counts = np.unique(np.array(self._pending, dtype=np.int64), return_counts=True)
+        self._pending = list()
+        self._ids, self._counts = _merge_sorted_counts(self._ids, self._counts, new_ids, new_counts.astype(np.int64))
+
+    def merge(self, other):
+        other._flush()
+        self._flush()
+        self._ids, self._counts = _merge_sorted_counts(self._ids, self._counts, other._ids, other._counts.copy())
+        return self
+
+    def most_common(self, n=None):
+        self._flush()
+        order = np.argsort(-self._counts, kind='mergesort')
+        if n is not None:
+            order = order[:n]
+        return [(int(id_), int(count)) for id_, count in zip(self._ids[order], self._counts[order])]
+
+    def items(self):
+        self._flush()
+        return [(int(id_), int(count)) for id_, count in zip(self._ids, self._counts)]
+
+    def arrays(self):
+        """
+        Returns the counted ids (sorted) and their counts, as int64 numpy arrays.
+        """
+        self._flush()
+        return self._ids.copy(), self._counts.copy()
+
+    def __getitem__(self, id_):
+        self._flush()
+        i = np.searchsorted(self._ids, id_)
+        if i < len(self._ids) and self._ids[i] == id_:
+            return int(self._counts[i])
+        return 0
+
+    def __len__(self):
+        self._flush()
+        return len(self._ids)
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    def __repr__(self):
+        return "IdCounter(ids={0})".format(len(self))
+
+
+class IdSet(object):
+    """
+    Set of integer ids, kept as a sorted int64 numpy array. New ids are buffered
+    in a python set and merged into the array a batch at a time; the buffer grows
+    with the array (up to 1/8 of its size) so that merging stays linear overall.
+    Supports `add`, `update`, `in`, `len` and merging (`a.merge(b)` or `a |= b`),
+    and can be pickled to be merged with the sets of other workers.
+
+    Example:
+    ########
+    users = IdSet()
+    users.update(tweet['user']['id'] for tweet in collection)
+    len(users)
+    """
+    def __init__(self, batch_size=100000):
+        self.batch_size = batch_size
+        self._pending = set()
+        self._ids = np.zeros(0, dtype=np.int64)
+
+    def add(self, id_):
+        self._pending.add(id_)
+        if len(self._pending) >= max(self.batch_size, len(self._ids) // 8):
+            self._flush()
+
+    def update(self, ids):
+        for id_ in ids:
+            self.add(id_)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        new_ids = np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))
+        self._pending = set()
+        self._ids = np.union1d(self._ids, new_ids)
+
+    def __contains__(self, id_):
+        if id_ in self._pending:
+            return True
+        i = self._ids.searchsorted(id_)
+        return bool(i < len(self._ids) and self._ids[i] == id_)
+
+    def merge(self, other):
+        other._flush()
+        self._flush()
+        self._ids = np.union1d(self._ids, other._ids)
+        return self
+
+    def __ior__(self, other):
+        return self.merge(other)
+
+    def __len__(self):
+        self._flush()
+        return len(self._ids)
+
+    def __iter__(self):
+        self._flush()
+        return (int(id_) for id_ in self._ids)
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    def __repr__(self):
+        return "IdSet(ids={0})".format(len(self))
+
+
+class IdMap(object):
+    """
+    Map of integer ids to the first value added for each of them, kept as a sorted
+    int64 numpy array of ids and an int32 array of value codes (values are stored
+    once each, so a map of users to their location takes 12 bytes per user plus the
+    distinct locations). New ids are buffered like in IdSet. Supports `add`, `in`,
+    `len`, `value_counts` and merging (the values already in the map are kept), and
+    can be pickled to be merged with the maps of other workers.
+
+    Example:
+    ########
+    locations = IdMap()
+    for tweet in collection:
+        locations.add(tweet['user']['id'], tweet['user']['location'])
+    locations.value_counts()
+    """
+    def __init__(self, batch_size=100000):
+        self.batch_size = batch_size
+        self._pending = dict()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._codes = np.zeros(0, dtype=np.int32)
+        self._values = list()
+        self._value_codes = dict()
+
+    def _code(self, value):
+        try:
+            return self._value_codes[value]
+        except KeyError:
+            code = self._value_codes[value] = len(self._values)
+            self._values.append(value)
+            return code
+
+    def add(self, id_, value):
+        if id_ in self._pending:
+            return
+        self._pending[id_] = self._code(value)
+        if len(self._pending) >= max(self.batch_size, len(self._ids) // 8):
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        new_ids = np.fromiter(self._pending.iterkeys(), dtype=np.int64, count=len(self._pending))
+        new_codes = np.fromiter(self._pending.itervalues(), dtype=np.int32, count=len(self._pending))
+        self._pending = dict()
+        self._insert(new_ids, new_codes)
+
+    def _insert(self, new_ids, new_codes):
+        """
+        Adds the distinct `new_ids` that are not in the map yet, with their `new_codes`.
+        """
+        order = np.argsort(new_ids, kind='mergesort')
+        new_ids, new_codes = new_ids[order], new_codes[order]
+        positions = np.searchsorted(self._ids, new_ids)
+        found = positions < len(self._ids)
+        found[found] = self._ids[positions[found]] == new_ids[found]
+        new = ~found
+        if new.any():
+            self._ids = np.insert(self._ids, positions[new], new_ids[new])
+            self._codes = np.insert(self._codes, positions[new], new_codes[new])
+
+    def __contains__(self, id_):
+        if id_ in self._pending:
+            return True
+        i = self._ids.searchsorted(id_)
+        return bool(i < len(self._ids) and self._ids[i] == id_)
+
+    def merge(self, other):
+        other._flush()
+        self._flush()
+        codes = np.array([self._code(value) for value in other._values], dtype=np.int32)
+        if len(other._ids):
+            self._insert(other._ids, codes[other._codes])
+        return self
+
+    def value_counts(self):
+        """
+        Returns a dict of value -> number of ids with that value.
+        """
+        self._flush()
+        counts = np.bincount(self._codes, minlength=len(self._values))
+        return dict((value, int(count)) for value, count in zip(self._values, counts) if count)
+
+    def __len__(self):
+        self._flush()
+        return len(self._ids)
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    def __repr__(self):
+        return "IdMap(ids={0})".format(len(self))
@@ -2,12 +2,19 @@
 Module contains functions to count top_things in collections of tweets.
 """
 
+import re
+import numpy as np
 import pandas as pd
 from smappPy.iter_util import get_ngrams
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, OrderedDict
 from smappPy.text_clean import get_cleaned_tokens
 from smappPy.entities import get_users_mentioned, get_hashtags
 from smappPy.entities import get_urls, get_links, get_image_urls
+from ngrams import NgramCounter
+from token_memo import TokenMemo, weighted_tokens
+from time_buckets import bucket_starts
+from sketches import _new_counter, HyperLogLog
+from compact_ids import IdSet
 
 def _counter_to_series(counter, n=None):
     if len(counter) < 1:
@@ -19,53 +26,62 @@ def _counter_to_series(counter, n=None):
     return pd.Series(counts, index=names)
 
 def _top_user_locations(collection, n=None, count_each_user_once=True):
-    users = set()
+    users = IdSet()
     loc_counts = Counter()
     for tweet in collection:
-        if tweet["user"]["id"] in users and count_each_user_once:
-            continue
-        users.add(tweet["user"]["id"])
+        if count_each_user_once:
+            if tweet["user"]["id"] in users:
+                continue
+            users.add(tweet["user"]["id"])
         if tweet["user"]["location"]:
             loc_counts[tweet["user"]["location"]] += 1
     return _counter_to_series(loc_counts, n)
 
-def _top_ngrams(collection, ngram, n, hashtags, mentions, rts, mts, https, stopwords):
-    counts = Counter()
-    for tweet in collection:
-        tokens = get_cleaned_tokens(tweet["text"],
-                                    keep_hashtags=hashtags,
-                                    keep_mentions=mentions,
-                                    rts=rts,
-                                    mts=mts,
-                                    https=https,
-                                    stopwords=stopwords)
-        ngrams = get_ngrams(tokens, ngram)
-        counts.update(' '.join(e) for e in ngrams)
+def _top_ngrams(collection, ngram, n, hashtags, mentions, rts, mts, https, stopwords, capacity=None):
+    if capacity:
+        counts = _new_counter(capacity)
+        def add(tokens, weight):
+            ngrams = Counter(' '.join(e) for e in get_ngrams(tokens, ngram))
+            counts.update(dict((k, v * weight) for k, v in ngrams.iteritems()))
+    else:
+        counts = NgramCounter(ngram)
+        add = counts.add
+    tokenize = lambda text: get_cleaned_tokens(text,
+                                               keep_hashtags=hashtags,
+                                               keep_mentions=mentions,
+                                               rts=rts,
+                                               mts=mts,
+                                               https=https,
+                                               stopwords=stopwords)
+    for tokens, weight in weighted_tokens(collection, tokenize):
+        add(tokens, weight)
     return _counter_to_series(counts, n)
 
-def _top_unigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-    return _top_ngrams(collection, 1, n, hashtags, mentions, rts, mts, https, stopwords)
+def _top_unigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
+    return _top_ngrams(collection, 1, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
-def _top_bigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-    return _top_ngrams(collection, 2, n, hashtags, mentions, rts, mts, https, stopwords)
+def _top_bigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
+    return _top_ngrams(collection, 2, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
-def _top_trigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[]):
-    return _top_ngrams(collection, 3, n, hashtags, mentions, rts, mts, https, stopwords)
+def _top_trigrams(collection, n=None, hashtags=True, mentions=True, rts=False, mts=False, https=False, stopwords=[], capacity=None):
+    return _top_ngrams(collection, 3, n, hashtags, mentions, rts, mts, https, stopwords, capacity)
 
 def _top_links(collection, n=None):
     counter = Counter([l for tweet in collection for l in get_links(tweet)])
     return _counter_to_series(counter, n)
 
-def _top_urls(collection, n=None):
-    counter = Counter([u for tweet in collection for u in get_urls(tweet)])
+def _top_urls(collection, n=None, capacity=None):
+    counter = _new_counter(capacity)
+    counter.update(u for tweet in collection for u in get_urls(tweet))
     return _counter_to_series(counter, n)
 
 def _top_images(collection, n=10):
     counter = Counter([i for tweet in collection for i in get_image_urls(tweet)])
     return _counter_to_series(counter, n)
 
-def _top_hashtags(collection, n=10):
-    counter = Counter([h for tweet in collection for h in [x.lower() for x in get_hashtags(tweet)]])
+def _top_hashtags(collection, n=10, capacity=None):
+    counter = _new_counter(capacity)
+    counter.update(h for tweet in collection for h in [x.lower() for x in get_hashtags(tweet)])
     return _counter_to_series(counter, n)
 
 def _top_mentions(collection, n=10):
@@ -88,6 +104,13 @@ def _top_entities(collection, n=10, urls=True, images=True, hts=True, mentions=T
     user_locations=True, ngrams=(1,2), ngram_stopwords=[], ngram_hashtags=True, ngram_mentions=True,
     ngram_rts=False, ngram_mts=False, ngram_https=False):
     counters = defaultdict(Counter)
+    memo = TokenMemo(lambda text: get_cleaned_tokens(text,
+                                                     keep_hashtags=ngram_hashtags,
+                                                     keep_mentions=ngram_mentions,
+                                                     rts=ngram_rts,
+                                                     mts=ngram_mts,
+                                                     https=ngram_https,
+                                                     stopwords=ngram_stopwords))
     for tweet in collection:
         if urls:
             for url in get_urls(tweet):
@@ -106,20 +129,75 @@ def _top_entities(collection, n=10, urls=True, images=True, hts=True, mentions=T
         if user_locations:
             counters['user_locations'][tweet['user'].get('location', None)] += 1
         if ngrams:
-            tokens = get_cleaned_tokens(tweet["text"],
-                                keep_hashtags=ngram_hashtags,
-                                keep_mentions=ngram_mentions,
-                                rts=ngram_rts,
-                                mts=ngram_mts,
-                                https=ngram_https,
-                                stopwords=ngram_stopwords)
+            tokens = memo.tokens(tweet)
             for ngram in ngrams:
                 grams = get_ngrams(tokens, ngram)
                 counters['{}-grams'.format(ngram)].update(' '.join(e) for e in grams)
     return { key: _counter_to_series(counters[key], n) for key in counters }
 
-def _unique_users(collection):
-    uids = set()
+def _unique_users(collection, approximate=False, precision=14):
+    uids = HyperLogLog(precision) if approximate else IdSet()
     for tweet in collection:
         uids.add(tweet['user']['id'])
     return pd.Series([len(uids)], index=['unique_users'])
+
+_COUNTS_TOKENIZER_REGEXP = re.compile('\w+')
+
+def _term_counts(collection, terms, time_unit='days', match='tokens', case_sensitive=False, batch_size=100000):
+    """
+    Counts, per `time_unit` bucket, the tweets that contain each of `terms` and the
+    total number of tweets, in a single pass. Each text is tokenized once and its
+    tokens are intersected with the set of terms. Returns a DataFrame indexed by the
+    start of each bucket, with a column per term and a '_total' column.
+    """
+    if not case_sensitive:
+        terms = [t.lower() for t in terms]
+    terms = list(OrderedDict.fromkeys(terms))
+    term_index = dict((term, i) for i, term in enumerate(terms))
+    n_columns = len(terms) + 1
+
+    if match == 'tokens':
+        termset = frozenset(terms)
+        if case_sensitive:
+            memo = TokenMemo(lambda text: frozenset(_COUNTS_TOKENIZER_REGEXP.findall(text)))
+        else:
+            memo = TokenMemo(lambda text: frozenset(_COUNTS_TOKENIZER_REGEXP.findall(text.lower())))
+        def matching_terms(tweet):
+            return [term_index[term] for term in memo.tokens(tweet) & termset]
+    elif match == 'substring':
+        def matching_terms(tweet):
+            text = tweet['text'] if case_sensitive else tweet['text'].lower()
+            return [i for i, term in enumerate(terms) if term in text]
+    else:
+        raise Exception("Illegal value for `match`. Legal values are ['tokens', 'substring'].")
+
+    counts = dict()
+    timestamps, hit_rows, hit_terms = list(), list(), list()
+
+    def flush():
+        buckets, rows = np.unique(bucket_starts(timestamps, time_unit), return_inverse=True)
+        codes = rows * n_columns + (n_columns - 1)
+        if hit_rows:
+            codes = np.concatenate([codes, rows[hit_rows] * n_columns + np.array(hit_terms, dtype=np.int64)])
+        batch = np.bincount(codes, minlength=len(buckets) * n_columns).reshape(len(buckets), n_columns)
+        for bucket, row in zip(buckets, batch):
+            if bucket in counts:
+                counts[bucket] += row
+            else:
+                counts[bucket] = row
+        del timestamps[:], hit_rows[:], hit_terms[:]
+
+    for tweet in collection:
+        row = len(timestamps)
+        timestamps.append(tweet['timestamp'])
+        for i in matching_terms(tweet):
+            hit_rows.append(row)
+            hit_terms.append(i)
+        if len(timestamps) >= batch_size:
+            flush()
+    if timestamps:
+        flush()
+
+    buckets = sorted(counts)
+    return pd.DataFrame([counts[b] for b in buckets], index=pd.to_datetime(buckets),
+        columns=terms + ['_total'], dtype=np.int64)
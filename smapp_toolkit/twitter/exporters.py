@@ -0,0 +1,177 @@
+"""
+Module contains buffered writers used by the dump_x() methods of collections.
+"""
+
+import csv
+import zlib
+import cStringIO
+from collections import deque, OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+# buffer of the raw BSON files read and written by dump_bson_to_path and apply_labels
+RAW_BUFFER_SIZE = 4 * 1024 * 1024
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+    """
+    File-like object that writes a standard `.gz` file, compressing blocks of
+    `block_size` bytes on `workers` threads (zlib releases the GIL while compressing).
+    Each block is a complete gzip member; gzip readers (gunzip, python's gzip module,
+    pandas) read the concatenated members as a single stream.
+
+    Example:
+    ########
+    with ParallelGzipWriter('tweets.csv.gz', workers=4) as f:
+        f.write(data)
+    """
+    def __init__(self, filename, workers=None, block_size=4 * 1024 * 1024, level=6):
+        self.workers = workers or cpu_count()
+        self.block_size = block_size
+        self.level = level
+        self._file = open(filename, 'wb')
+        self._pool = ThreadPool(self.workers)
+        self._pending = deque()
+        self._buffer = list()
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        if not self._buffered:
+            return
+        block = ''.join(self._buffer)
+        self._buffer = list()
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.level)))
+        # keep memory bounded: at most two blocks per worker in flight
+        while len(self._pending) > 2 * self.workers:
+            self._file.write(self._pending.popleft().get())
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._submit()
+            while self._pending:
+                self._file.write(self._pending.popleft().get())
+        finally:
+            self._pool.terminate()
+            self._pool.join()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BatchedCSVWriter(object):
+    """
+    Writes rows of unicode strings as utf-8 CSV (the same output as smappPy's
+    UnicodeWriter), encoding `batch_size` rows at a time into an in-memory buffer
+    before writing it to `stream`.
+    """
+    def __init__(self, stream, batch_size=10000):
+        self.stream = stream
+        self.batch_size = batch_size
+        self._queue = cStringIO.StringIO()
+        self._writer = csv.writer(self._queue)
+        self._rows = 0
+
+    def writerow(self, row):
+        self._writer.writerow([value.encode('utf-8') for value in row])
+        self._rows += 1
+        if self._rows >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.stream.write(self._queue.getvalue())
+        self._queue.seek(0)
+        self._queue.truncate()
+        self._rows = 0
+
+
+class CSVLines(object):
+    """
+    Encodes rows of unicode strings to utf-8 CSV lines, one row at a time.
+    """
+    def __init__(self):
+        self._queue = cStringIO.StringIO()
+        self._writer = csv.writer(self._queue)
+
+    def encode(self, row):
+        self._writer.writerow([value.encode('utf-8') for value in row])
+        line = self._queue.getvalue()
+        self._queue.seek(0)
+        self._queue.truncate()
+        return line
+
+
+class PartitionedFiles(object):
+    """
+    Writes records to one file per partition, named by formatting `path_template` with
+    the partition (e.g. 'tweets_{}.bson'). At most `max_open` files are open at a time:
+    the least recently written one is closed when another has to be opened, and is
+    reopened for appending if it gets more records. Each open file has a write buffer
+    of `buffer_size` bytes. `header` is written at the start of every file.
+
+    Example:
+    ########
+    with PartitionedFiles('tweets_{}.bson', max_open=32) as files:
+        files.write('en', data)
+    """
+    def __init__(self, path_template, max_open=64, buffer_size=256 * 1024, header=''):
+        self.path_template = path_template
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.header = header
+        self._open = OrderedDict()
+        self._created = set()
+        self.reopened = 0
+
+    def path(self, partition):
+        if isinstance(partition, unicode):
+            partition = partition.encode('utf-8')
+        return self.path_template.format(partition)
+
+    def write(self, partition, data):
+        try:
+            f = self._open.pop(partition)
+        except KeyError:
+            f = self._file(partition)
+        self._open[partition] = f
+        f.write(data)
+
+    def _file(self, partition):
+        while len(self._open) >= self.max_open:
+            self._open.popitem(last=False)[1].close()
+        if partition in self._created:
+            self.reopened += 1
+            return open(self.path(partition), 'ab', self.buffer_size)
+        self._created.add(partition)
+        f = open(self.path(partition), 'wb', self.buffer_size)
+        f.write(self.header)
+        return f
+
+    def partitions(self):
+        return sorted(self._created)
+
+    def close(self):
+        while self._open:
+            self._open.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,268 @@
+"""
+Module contains the compiled label rules used by `apply_labels()`.
+
+The rules (a list of values for each field) are compiled once: the string values of a
+field are searched for with a single regular expression alternation, and the values
+of non-text fields (ids, numbers) are looked up in a set.
+"""
+
+import os
+import re
+import shutil
+from bson import BSON
+from bson.regex import Regex
+from multiprocessing import Pool, cpu_count
+
+from columns import _compile_column
+from exporters import RAW_BUFFER_SIZE
+
+
+class _FieldRule(object):
+    """
+    Matches the value of one field against a list of values, like the original
+    `apply_labels` loop did:
+    - text values match if one of the values is a substring of them,
+    - list (or dict) values match if they contain one of the values,
+    - other values (ids, numbers) match if they are equal to one of the values, or if
+      their text is (so that a user id matches '1234567').
+    Missing and empty fields never match.
+    """
+    def __init__(self, field, values):
+        self.field = field
+        self.values = list(values)
+        self._read = _compile_column(field, raw=True)
+        texts = [value for value in self.values if isinstance(value, basestring)]
+        # longest first, so that the alternation finds any value that is a substring
+        texts.sort(key=len, reverse=True)
+        self._pattern = re.compile(u'|'.join(re.escape(text) for text in texts), re.UNICODE) if texts else None
+        self._exact = set(value for value in self.values if _hashable(value))
+
+    def matches(self, tweet):
+        value = self._read(tweet)
+        if not value:
+            return False
+        if isinstance(value, basestring):
+            return self._pattern is not None and self._pattern.search(value) is not None
+        if isinstance(value, (list, tuple, dict)) or hasattr(value, 'keys'):
+            return any(v in value for v in self.values)
+        if not _hashable(value):
+            return False
+        return value in self._exact or unicode(value) in self._exact
+
+    def mongo_query(self):
+        """
+        The rule as a MongoDB query that matches the same tweets as `matches()`, or None
+        if it can't be translated. Tweets whose field has a BSON type that the query can't
+        mirror (see `_UNMIRRORED_TYPES`) are left out; select them with `unmirrored_query()`.
+        Requires MongoDB 3.6 or later (for `$type: 'array'` and lists of types).
+        """
+        parts = self.field.split('.')
+        if any(part.isdigit() or part.startswith('$') or not part for part in parts):
+            # list indices are read differently by MongoDB
+            return None
+        values = self.values
+        if any(isinstance(value, bool) or not isinstance(value, (basestring, int, long, float)) for value in values):
+            return None
+        texts = [value for value in values if isinstance(value, basestring)]
+        numbers = [value for value in values if not isinstance(value, basestring)]
+        text_ints = list()
+        for text in texts:
+            if not text:
+                return None
+            if _canonical_int(text):
+                text_ints.append(long(text))
+            elif _float_text(text):
+                # matches the floats whose text is `text`, which MongoDB can't select
+                return None
+        field = self.field
+        not_array = {field: {'$not': {'$type': 'array'}}}
+        clauses = list()
+        if texts:
+            # text fields contain one of the texts
+            clauses.append({'$and': [not_array, {field: Regex(self._pattern.pattern)}]})
+            # documents have one of the texts as a key (stored keys can't contain '.' or start with '$')
+            keys = [text for text in texts if '.' not in text and not text.startswith('$')]
+            if keys:
+                clauses.append({'$and': [not_array, {field: {'$type': 'object'}},
+                                         {'$or': [{field + '.' + key: {'$exists': True}} for key in keys]}]})
+        # lists have one of the values as an element (False == 0 and True == 1 in python)
+        elements = list(values)
+        elements.extend(flag for flag in (False, True) if any(value == flag for value in numbers))
+        clauses.append({'$and': [{field: {'$type': 'array'}}, {field: {'$in': elements}}]})
+        # numbers are equal to one of the numbers, integers also to one of the texts
+        numbers = [value for value in numbers if value]
+        if numbers:
+            clauses.append({'$and': [not_array, {field: {'$type': 'number'}}, {field: {'$in': numbers}}]})
+        if text_ints:
+            clauses.append({'$and': [not_array, {field: {'$type': ['int', 'long']}}, {field: {'$in': text_ints}}]})
+        # True is equal to 1 and its text is 'True'
+        if any(value == 1 for value in numbers) or u'True' in texts:
+            clauses.append({'$and': [not_array, {field: True}]})
+        guards = [{prefix: {'$not': {'$type': 'array'}}} for prefix in _prefixes(parts)]
+        guards.append({field: {'$not': {'$type': _UNMIRRORED_TYPES}}})
+        return {'$and': guards + [{'$or': clauses}]}
+
+    def unmirrored_query(self):
+        """
+        Query of the tweets whose field has a type that `mongo_query()` leaves out.
+        """
+        return {self.field: {'$type': _UNMIRRORED_TYPES}}
+
+
+# BSON types whose python values can match a rule in ways a query can't express
+# (e.g. a date matches the text of its value)
+_UNMIRRORED_TYPES = ['binData', 'objectId', 'date', 'regex', 'dbPointer', 'javascript', 'symbol',
+                     'javascriptWithScope', 'timestamp', 'decimal', 'minKey', 'maxKey']
+
+def _prefixes(parts):
+    return ['.'.join(parts[:i]) for i in range(1, len(parts))]
+
+def _canonical_int(text):
+    """
+    Whether `text` is the text of an integer (as `unicode(7)` is u'7', but not u'007').
+    """
+    try:
+        return unicode(long(text)) == text
+    except ValueError:
+        return False
+
+def _float_text(text):
+    """
+    Whether `text` is the text of a float (as `unicode(1.5)` is u'1.5').
+    """
+    try:
+        return unicode(float(text)) == text
+    except ValueError:
+        return False
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+class LabelMatcher(object):
+    """
+    Compiled `apply_labels` rules: a tweet matches if any of `fields` matches any of
+    its `values` (see `_FieldRule`). Matching tweets get the `labels` field built
+    from `list_of_labels`.
+
+    Example:
+    ########
+    matcher = LabelMatcher([['religious_rank'], ['imam']], ['user.screen_name'], [['Obama', 'Hillary']])
+    matcher.matches(tweet)
+    """
+    def __init__(self, list_of_labels, list_of_fields, list_for_values):
+        if len(list_of_fields) != len(list_for_values):
+            raise ValueError("list_of_fields and list_for_values must have the same length")
+        self.rules = [_FieldRule(field, values) for field, values in zip(list_of_fields, list_for_values)]
+        self.labels = dict()
+        for i, name in enumerate(list_of_labels[0]):
+            self.labels[str(i)] = {'name': name, 'type': list_of_labels[1][i]}
+
+    def matches(self, tweet):
+        for rule in self.rules:
+            if rule.matches(tweet):
+                return True
+        return False
+
+    def fields(self):
+        """
+        The fields the rules read, cut at the first list index (for MongoDB projections).
+        """
+        fields = set()
+        for rule in self.rules:
+            path = list()
+            for part in rule.field.split('.'):
+                if part.isdigit():
+                    break
+                path.append(part)
+            fields.add('.'.join(path))
+        return sorted(fields)
+
+    def mongo_query(self):
+        """
+        The rules as a MongoDB query that matches the same tweets as `matches()` (except
+        the tweets of `unmirrored_query()`), or None if one of them can't be translated.
+        """
+        queries = list()
+        for rule in self.rules:
+            query = rule.mongo_query()
+            if query is None:
+                return None
+            queries.append(query)
+        return {'$or': queries}
+
+    def unmirrored_query(self):
+        """
+        Query of the tweets that `mongo_query()` leaves out, which have to be matched
+        with `matches()`.
+        """
+        return {'$or': [rule.unmirrored_query() for rule in self.rules]}
+
+    def labeled(self, tweet, data):
+        """
+        Returns `tweet` (or its raw BSON `data`) with the labels added, as a dict.
+        """
+        if not isinstance(tweet, dict):
+            tweet = BSON(data).decode()
+        tweet['labels'] = dict((key, dict(label)) for key, label in self.labels.iteritems())
+        return tweet
+
+    def label(self, raw_tweets, outfile):
+        """
+        Writes the (tweet, raw BSON bytes) of `raw_tweets` to `outfile`, adding the labels
+        to the matching ones (the others are copied as they are).
+        Returns a dict with the number of 'matched' and 'unmatched' tweets.
+        """
+        stats = {'matched': 0, 'unmatched': 0}
+        for tweet, data in raw_tweets:
+            if self.matches(tweet):
+                stats['matched'] += 1
+                outfile.write(BSON.encode(self.labeled(tweet, data)))
+            else:
+                stats['unmatched'] += 1
+                outfile.write(data)
+        return stats
+
+
+# set before forking the workers of `label_in_parallel`, which inherit it
+_parallel_job = dict()
+
+def _label_range(job):
+    start, end, path = job
+    collection, matcher, buffer_size = _parallel_job['collection'], _parallel_job['matcher'], _parallel_job['buffer_size']
+    with open(path, 'wb', buffer_size) as outfile:
+        return matcher.label(collection._raw_tweets(start, end), outfile)
+
+def label_in_parallel(collection, matcher, outputpath, workers=None, buffer_size=RAW_BUFFER_SIZE):
+    """
+    Labels the tweets of a BSON `collection` with `workers` processes (default: one per
+    CPU), each labeling a contiguous range of the file into a part file. The parts are
+    then concatenated, in order, into `outputpath`.
+    Returns a dict with the number of 'matched' and 'unmatched' tweets.
+    """
+    workers = workers or cpu_count()
+    ranges = collection._document_ranges(workers)
+    parts = ['{0}.part{1}'.format(outputpath, i) for i in range(len(ranges))]
+    _parallel_job.update(collection=collection, matcher=matcher, buffer_size=buffer_size)
+    pool = Pool(workers)
+    try:
+        results = pool.map(_label_range, [(start, end, path) for (start, end), path in zip(ranges, parts)])
+    finally:
+        pool.terminate()
+        pool.join()
+        _parallel_job.clear()
+    try:
+        with open(outputpath, 'wb') as outfile:
+            for path in parts:
+                with open(path, 'rb') as part:
+                    shutil.copyfileobj(part, outfile, buffer_size)
+    finally:
+        for path in parts:
+            if os.path.exists(path):
+                os.remove(path)
+    return {'matched': sum(r['matched'] for r in results), 'unmatched': sum(r['unmatched'] for r in results)}
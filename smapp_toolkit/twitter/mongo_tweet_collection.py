@@ -1,10 +1,35 @@
 import re
 import copy
-from datetime import timedelta
+import pytz
+from datetime import datetime, timedelta
+from bson.regex import Regex
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from pymongo.cursor import Cursor
-from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo import MongoClient, UpdateOne, ASCENDING, DESCENDING
+from cache import cached_result
+from labeling import LabelMatcher
+from read_ahead import read_ahead, ReadAheadStats
 from base_tweet_collection import BaseTweetCollection
 
+_PATTERN_TYPE = type(re.compile(''))
+
+def _describe_query(value):
+    """
+    json-serializable description of a query: compiled regular expressions (from
+    `containing()`, `field_containing()`...) are described by their pattern and flags
+    and datetimes by their isoformat.
+    """
+    if isinstance(value, dict):
+        return dict((key, _describe_query(v)) for key, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_describe_query(v) for v in value]
+    if isinstance(value, (_PATTERN_TYPE, Regex)):
+        return {'$regex': value.pattern, '$flags': value.flags}
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
 class MongoTweetCollection(BaseTweetCollection):
     """
     Collection object for performing queries and getting data out of a MongoDB collection 
@@ -38,6 +63,9 @@ class MongoTweetCollection(BaseTweetCollection):
         self._limit = None
         self._sort = None
         self._no_cursor_timeout = False
+        self._cursor_batch_size = 0
+        self._read_ahead = None
+        self._read_ahead_stats = None
 
     def __repr__(self, ):
         return "Mongo Tweet Collection (DB, # filters, limit): {0}, {1}, {2}".format(
@@ -46,25 +74,112 @@ class MongoTweetCollection(BaseTweetCollection):
             self._limit)
 
     def __iter__(self):
+        tweets = self._cursor_tweets()
+        if self._read_ahead:
+            tweets = read_ahead(tweets, stats=self._read_ahead_stats, **self._read_ahead)
+
+        i = 1
+        try:
+            for tweet in tweets:
+                if self._limit is not None and i > self._limit:
+                    raise StopIteration
+                i += 1
+                yield tweet
+        finally:
+            tweets.close()
+
+    def _cursor_tweets(self, raw=False):
+        collections = self._mongo_collections
+        if raw:
+            codec_options = CodecOptions(document_class=RawBSONDocument)
+            collections = [collection.with_options(codec_options=codec_options) for collection in collections]
         if self._sort:
-            cursors = [Cursor(collection, self._query(), no_cursor_timeout=self._no_cursor_timeout, sort=[self._sort]) \
-                for collection in self._mongo_collections]
+            cursors = [Cursor(collection, self._query(), no_cursor_timeout=self._no_cursor_timeout, sort=[self._sort],
+                batch_size=self._cursor_batch_size) for collection in collections]
         else:
-            cursors = [Cursor(collection, self._query(), no_cursor_timeout=self._no_cursor_timeout) \
-                for collection in self._mongo_collections]
+            cursors = [Cursor(collection, self._query(), no_cursor_timeout=self._no_cursor_timeout,
+                batch_size=self._cursor_batch_size) for collection in collections]
 
-        i = 1
         try:
             for cursor in cursors:
                 for tweet in cursor:
-                    if self._limit is not None and i > self._limit:
-                        raise StopIteration
-                    i += 1
                     yield tweet
         finally:
             for cursor in cursors:
                 cursor.close()
 
+    def _raw_tweets(self):
+        """
+        Yields (tweet, raw BSON bytes) of the matching tweets. Tweets are RawBSONDocuments,
+        which only decode the fields that are read.
+        """
+        tweets = self._cursor_tweets(raw=True)
+        i = 1
+        try:
+            for tweet in tweets:
+                if self._limit is not None and i > self._limit:
+                    break
+                i += 1
+                yield tweet, tweet.raw
+        finally:
+            tweets.close()
+
+    def _raw_documents(self):
+        """
+        Yields the raw BSON bytes of the matching tweets, as sent by the server.
+        """
+        for _, data in self._raw_tweets():
+            yield data
+
+    def _describe(self):
+        """
+        Description of the database, collections and query of this collection, used to fingerprint it.
+        """
+        if self._limit is not None:
+            raise ValueError("Collection with a limit can not be fingerprinted")
+        return {'database': "{0}:{1}/{2}".format(self._client.host, self._client.port, self._mongo_database.name),
+                'collections': [collection.name for collection in self._mongo_collections],
+                'query': _describe_query(self._query())}
+
+    def _results_are_final(self):
+        """
+        Tweets are only ever added to the collections, so results are final if the
+        collection only covers times in the past.
+        """
+        until = self._get_until()
+        if until is None:
+            return False
+        now = datetime.now(pytz.UTC) if until.tzinfo else datetime.utcnow()
+        return until < now
+
+    def _is_valid_watermark(self, watermark):
+        return watermark is not None
+
+    def _tweets_after(self, watermark, progress):
+        """
+        Yields the tweets matching the query that were inserted after `watermark` (a dict of
+        collection name -> highest `_id` read, or None to read everything). Each collection
+        is read up to its highest `_id` when reading starts, tweets inserted meanwhile are
+        left for the next call. `progress['watermark']` is moved as each collection is read.
+        """
+        watermark = dict(watermark or {})
+        for collection in self._mongo_collections:
+            last = list(collection.find({}, ['_id']).sort('_id', DESCENDING).limit(1))
+            if not last:
+                continue
+            id_range = {'$lte': last[0]['_id']}
+            if collection.name in watermark:
+                id_range['$gt'] = watermark[collection.name]
+            query = {'$and': [self._query(), {'_id': id_range}]}
+            cursor = Cursor(collection, query, no_cursor_timeout=self._no_cursor_timeout, batch_size=self._cursor_batch_size)
+            try:
+                for tweet in cursor:
+                    yield tweet
+            finally:
+                cursor.close()
+            watermark[collection.name] = last[0]['_id']
+            progress['watermark'] = dict(watermark)
+
     def _copy(self):
         ret = copy.copy(self)
         ret._queries = [copy.deepcopy(q) if 'timestamp' in q.keys() else copy.copy(q) for q in self._queries]
@@ -249,6 +364,25 @@ class MongoTweetCollection(BaseTweetCollection):
         ret._limit = count
         return ret
 
+    def read_ahead(self, batch_size=1000, queue_size=8, cursor_batch_size=None):
+        """
+        Fetch and decode tweets in a background thread, handing them over in batches
+        of `batch_size`. At most `queue_size` batches are fetched ahead of the consumer.
+        `cursor_batch_size` is the number of documents per round-trip to the server
+        (defaults to `batch_size`). Throughput is reported by `throughput()`.
+
+        Example:
+        ########
+        col = collection.since(datetime(2015,6,1)).read_ahead(batch_size=5000)
+        col.top_hashtags()
+        col.throughput()
+        """
+        ret = self._copy()
+        ret._read_ahead = {'batch_size': batch_size, 'queue_size': queue_size}
+        ret._read_ahead_stats = ReadAheadStats()
+        ret._cursor_batch_size = cursor_batch_size or batch_size
+        return ret
+
     def time_range(self, ):
         """
         Returns a tuple: (first_tweet_date, last_tweet_date)
@@ -274,6 +408,7 @@ class MongoTweetCollection(BaseTweetCollection):
         ret._sort = (field, direction)
         return ret
 
+    @cached_result
     def count(self):
         """
         The count of tweets in the collection matching all specified criteria.
@@ -290,6 +425,78 @@ class MongoTweetCollection(BaseTweetCollection):
             return sum(col.find(self._query()).count(with_limit_and_skip=True) \
                 for col in self._mongo_collections)
 
+    def apply_labels_in_place(self, list_of_labels, list_of_fields, list_for_values, batch_size=1000):
+        """
+        Adds the labels of `apply_labels()` to the matching tweets in the database itself
+        instead of writing them to a new BSON file.
+
+        If the rules can be translated into a MongoDB query that matches the same tweets
+        as `apply_labels()`, each collection is labeled with a single `update_many` and the
+        tweets never leave the server; the few tweets whose fields have types the query
+        can't mirror (dates, ObjectIds, ...) are then matched like below. Otherwise (values
+        that are documents or booleans, fields with list indices, or a `limit()`), only the
+        fields used by the rules are read, and the matching tweets are updated with
+        unordered `bulk_write`s of `batch_size` updates.
+
+        Returns a dict with the number of 'matched' and 'modified' tweets.
+
+        Example:
+        ########
+        collection.since(datetime(2015,1,1)).apply_labels_in_place(
+            [['religious_rank'], ['imam']], ['user.screen_name'], [['Obama', 'Hillary']])
+        """
+        matcher = LabelMatcher(list_of_labels, list_of_fields, list_for_values)
+        update = {'$set': {'labels': matcher.labels}}
+        stats = {'matched': 0, 'modified': 0}
+        rules_query = matcher.mongo_query()
+        if rules_query is not None and self._limit is None:
+            query = {'$and': [self._query(), rules_query]}
+            unmirrored = {'$and': [self._query(), matcher.unmirrored_query(), {'$nor': [rules_query]}]}
+            for collection in self._mongo_collections:
+                result = collection.update_many(query, update)
+                stats['matched'] += result.matched_count
+                stats['modified'] += result.modified_count
+                self._label_matching(collection, unmirrored, matcher, update, batch_size, stats)
+            return stats
+
+        remaining = self._limit
+        for collection in self._mongo_collections:
+            if remaining is not None and remaining <= 0:
+                break
+            remaining = self._label_matching(collection, self._query(), matcher, update, batch_size, stats, remaining)
+        return stats
+
+    def _label_matching(self, collection, query, matcher, update, batch_size, stats, limit=None):
+        """
+        Updates the tweets of `query` that `matcher` matches, reading at most `limit` tweets.
+        Returns the rest of `limit`.
+        """
+        cursor = Cursor(collection, query, projection=matcher.fields(), no_cursor_timeout=self._no_cursor_timeout,
+            batch_size=self._cursor_batch_size)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        requests = list()
+        try:
+            for tweet in cursor:
+                if limit is not None:
+                    limit -= 1
+                if matcher.matches(tweet):
+                    requests.append(UpdateOne({'_id': tweet['_id']}, update))
+                if len(requests) >= batch_size:
+                    self._bulk_update(collection, requests, stats)
+                    requests = list()
+        finally:
+            cursor.close()
+        self._bulk_update(collection, requests, stats)
+        return limit
+
+    def _bulk_update(self, collection, requests, stats):
+        if not requests:
+            return
+        result = collection.bulk_write(requests, ordered=False)
+        stats['matched'] += result.matched_count
+        stats['modified'] += result.modified_count
+
     def _merge(self, a, b, path=None):
         "Merge dictionaries of dictionaries"
         if path is None: path = []
@@ -0,0 +1,384 @@
+"""
+Module contains streaming builders of user networks (retweets, mentions, replies).
+
+`UserNetwork` keeps the network in memory: users are numbered as they are first seen
+and their metadata is only read then, and edges are kept as int64 codes of (source,
+target) numbers in an IdCounter, so repeated edges are collapsed into weights a batch
+at a time.
+
+`ExternalNetwork` keeps memory bounded whatever the size of the network: nodes and
+edges are written to sorted runs on disk, which are merged (and repeated edges
+summed) as the network is written out as GraphML or CSV.
+"""
+
+import os
+import json
+import heapq
+import shutil
+import tempfile
+import numpy as np
+import networkx as nx
+from array import array
+from xml.sax.saxutils import escape, quoteattr
+from smappPy.xml_util import clear_unicode_control_chars
+
+from columns import _compile_column
+from compact_ids import IdCounter
+from exporters import CSVLines
+
+
+def _metadata_readers(fields):
+    return [(field, _compile_column(field)) for field in fields]
+
+def _metadata(obj, readers):
+    """
+    Dict of field -> value (as unicode, without control characters) of the fields
+    read by `readers` (see `_metadata_readers`).
+    """
+    return dict((field, clear_unicode_control_chars(read(obj))) for field, read in readers)
+
+
+class UserNetwork(object):
+    """
+    Directed, weighted network of users. Nodes are users (by `id_str`) with their
+    `user_metadata` fields as attributes, read the first time each user is seen.
+    Repeated edges between the same users are collapsed into one edge whose weight is
+    their number; the `edge_metadata` fields are read from the first tweet of each edge.
+
+    The network can be exported as arrays of (source, target, weight), as a SciPy sparse
+    adjacency matrix, or as a networkx DiGraph.
+
+    Example:
+    ########
+    network = UserNetwork(user_metadata=['screen_name'])
+    for tweet in collection.only_retweets():
+        network.add_edge(tweet['user'], tweet['retweeted_status']['user'], tweet)
+    sources, targets, weights = network.edges()
+    network.node_ids[sources[0]]
+    """
+    def __init__(self, user_metadata=(), edge_metadata=(), name=None):
+        self.name = name
+        self._user_readers = _metadata_readers(user_metadata)
+        self._edge_readers = _metadata_readers(edge_metadata)
+        self._index = dict()
+        self.node_ids = list()
+        self.node_attributes = list()
+        self._edges = IdCounter()
+        self._edge_attributes = dict()
+
+    def __repr__(self):
+        return "UserNetwork(nodes={0}, edges={1})".format(len(self.node_ids), len(self._edges))
+
+    def add_user(self, user):
+        """
+        Adds `user` (a tweet's user object) if it's not in the network yet.
+        Returns its node number.
+        """
+        id_str = user['id_str']
+        try:
+            return self._index[id_str]
+        except KeyError:
+            i = self._index[id_str] = len(self.node_ids)
+            self.node_ids.append(id_str)
+            self.node_attributes.append(_metadata(user, self._user_readers))
+            return i
+
+    def add_edge(self, source, target, tweet=None):
+        """
+        Adds an edge from user `source` to user `target`, for `tweet`.
+        """
+        code = (self.add_user(source) << 32) | self.add_user(target)
+        self._edges.add(code)
+        if self._edge_readers and code not in self._edge_attributes:
+            self._edge_attributes[code] = _metadata(tweet, self._edge_readers)
+
+    def edges(self):
+        """
+        Returns the node numbers of the sources and targets of the edges and their
+        weights, as int64 numpy arrays sorted by source then target. Node numbers are
+        indices into `node_ids` and `node_attributes`.
+        """
+        codes, weights = self._edges.arrays()
+        return codes >> 32, codes & 0xffffffff, weights
+
+    def to_sparse(self):
+        """
+        Returns the weighted adjacency matrix as a SciPy CSR matrix, with a row and a
+        column per node (in the order of `node_ids`). Requires scipy.
+        """
+        try:
+            from scipy.sparse import coo_matrix
+        except ImportError:
+            raise ImportError("to_sparse requires scipy (pip install scipy)")
+        sources, targets, weights = self.edges()
+        n = len(self.node_ids)
+        return coo_matrix((weights, (sources, targets)), shape=(n, n)).tocsr()
+
+    def to_networkx(self):
+        """
+        Returns the network as a networkx DiGraph. Edges have a 'weight' attribute along
+        with their metadata.
+        """
+        dg = nx.DiGraph(name=self.name)
+        dg.add_nodes_from(zip(self.node_ids, self.node_attributes))
+        codes, weights = self._edges.arrays()
+        dg.add_edges_from(self._networkx_edges(codes, weights))
+        return dg
+
+    def _networkx_edges(self, codes, weights):
+        node_ids = self.node_ids
+        for code, weight in zip(codes.tolist(), weights.tolist()):
+            attributes = dict(self._edge_attributes.get(code, ()))
+            attributes['weight'] = weight
+            yield node_ids[code >> 32], node_ids[code & 0xffffffff], attributes
+
+
+# runs merged at once: when there are more, they are first merged into bigger runs,
+# `_MERGE_FAN_IN` at a time, so that open files and read buffers stay bounded
+_MERGE_FAN_IN = 64
+
+def _edge_run(path, block_rows=4096):
+    """
+    Yields the (source, target, weight) rows of an edge run written by ExternalNetwork.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            block = np.fromfile(f, dtype=np.int64, count=block_rows * 3)
+            if not len(block):
+                break
+            for row in block.reshape(-1, 3).tolist():
+                yield tuple(row)
+
+def _merge_edge_runs(paths):
+    """
+    Yields the (source, target, weight) rows of the edge runs at `paths`, ordered by
+    source then target, with the weights of repeated edges summed.
+    """
+    current, weight = None, 0
+    for source, target, w in heapq.merge(*[_edge_run(path) for path in paths]):
+        if (source, target) != current:
+            if current is not None:
+                yield current[0], current[1], weight
+            current, weight = (source, target), 0
+        weight += w
+    if current is not None:
+        yield current[0], current[1], weight
+
+def _write_edge_run(path, rows, block_rows=4096):
+    with open(path, 'wb') as f:
+        block = list()
+        for row in rows:
+            block.append(row)
+            if len(block) >= block_rows:
+                np.array(block, dtype=np.int64).tofile(f)
+                block = list()
+        if block:
+            np.array(block, dtype=np.int64).tofile(f)
+
+def _node_run(path, run):
+    """
+    Yields the (id, priority, run, metadata json) of the nodes of a node run.
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            id_, priority, metadata = line.rstrip('\n').split('\t', 2)
+            yield int(id_), int(priority), run, metadata
+
+def _merge_node_runs(paths):
+    """
+    Yields the (id, priority, metadata json) of the nodes of the node runs at `paths`,
+    ordered by id, keeping for each id the node with the lowest priority (the one of
+    the first run among equals).
+    """
+    last = None
+    for id_, priority, _, metadata in heapq.merge(*[_node_run(path, run) for run, path in enumerate(paths)]):
+        if id_ != last:
+            last = id_
+            yield id_, priority, metadata
+
+def _write_node_run(path, rows):
+    with open(path, 'wb', 1024 * 1024) as f:
+        for id_, priority, metadata in rows:
+            f.write('{0}\t{1}\t{2}\n'.format(id_, priority, metadata))
+
+
+class ExternalNetwork(object):
+    """
+    Directed, weighted network of users that is kept on disk, so that memory stays
+    bounded (by `chunk_size` nodes and edges) whatever the size of the network.
+
+    Nodes are users, identified by their numeric id, with their `user_metadata` fields
+    as attributes. A user can be seen with more or less metadata (the author of a tweet
+    has a full user object, a mentioned user only has an id and names): the metadata
+    with the lowest `priority` is kept, the first seen among equals.
+    Every `chunk_size` edges (or nodes), the buffered ones are sorted, repeated edges
+    are summed, and they are written to a run file in `temp_dir`. Runs are merged when
+    the network is written with `write_graphml()` or `write_csv()`, at most
+    `_MERGE_FAN_IN` at a time (more runs are first merged into intermediate runs).
+
+    Example:
+    ########
+    network = ExternalNetwork(user_metadata=['id_str', 'screen_name'])
+    for tweet in collection:
+        for mention in tweet['entities']['user_mentions']:
+            network.add_edge(tweet['user'], mention, target_priority=1)
+    network.write_graphml('mentions.graphml')
+    network.close()
+    """
+    def __init__(self, user_metadata=(), chunk_size=1000000, temp_dir=None, name=None):
+        self.name = name
+        self.user_metadata = list(user_metadata)
+        self.chunk_size = chunk_size
+        self._readers = _metadata_readers(self.user_metadata)
+        self._directory = tempfile.mkdtemp(prefix='smapp-network-', dir=temp_dir)
+        self._nodes = dict()
+        self._sources = array('l')
+        self._targets = array('l')
+        self._node_runs = list()
+        self._edge_runs = list()
+        self._run_count = 0
+
+    def __repr__(self):
+        return "ExternalNetwork(node runs={0}, edge runs={1})".format(len(self._node_runs), len(self._edge_runs))
+
+    def add_user(self, user, priority=0):
+        """
+        Adds `user` (a user object, or a dict with at least an 'id') to the network.
+        Returns its id.
+        """
+        id_ = user['id']
+        known = self._nodes.get(id_)
+        if known is None or known[0] > priority:
+            self._nodes[id_] = (priority, _metadata(user, self._readers))
+            if len(self._nodes) >= self.chunk_size:
+                self._flush_nodes()
+        return id_
+
+    def add_edge(self, source, target, source_priority=0, target_priority=0):
+        """
+        Adds an edge from user `source` to user `target`.
+        """
+        self._sources.append(self.add_user(source, source_priority))
+        self._targets.append(self.add_user(target, target_priority))
+        if len(self._sources) >= self.chunk_size:
+            self._flush_edges()
+
+    def _run_path(self, kind):
+        self._run_count += 1
+        return os.path.join(self._directory, '{0}-{1}'.format(kind, self._run_count))
+
+    def _flush_nodes(self):
+        if not self._nodes:
+            return
+        path = self._run_path('nodes')
+        _write_node_run(path, ((id_, self._nodes[id_][0], json.dumps(self._nodes[id_][1])) for id_ in sorted(self._nodes)))
+        self._node_runs.append(path)
+        self._nodes = dict()
+
+    def _flush_edges(self):
+        if not self._sources:
+            return
+        sources = np.frombuffer(self._sources, dtype=np.dtype('l')).astype(np.int64)
+        targets = np.frombuffer(self._targets, dtype=np.dtype('l')).astype(np.int64)
+        order = np.lexsort((targets, sources))
+        sources, targets = sources[order], targets[order]
+        starts = np.flatnonzero(np.r_[True, (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])])
+        weights = np.diff(np.r_[starts, len(sources)])
+        rows = np.column_stack((sources[starts], targets[starts], weights)).astype(np.int64)
+        path = self._run_path('edges')
+        rows.tofile(path)
+        self._edge_runs.append(path)
+        self._sources = array('l')
+        self._targets = array('l')
+
+    def _merged_runs(self, kind, runs, merge, write):
+        """
+        Merges `runs`, `_MERGE_FAN_IN` consecutive runs at a time (so the order of the
+        node runs is kept), until there are at most `_MERGE_FAN_IN` of them.
+        """
+        while len(runs) > _MERGE_FAN_IN:
+            merged = list()
+            for i in range(0, len(runs), _MERGE_FAN_IN):
+                group = runs[i:i + _MERGE_FAN_IN]
+                if len(group) == 1:
+                    merged.append(group[0])
+                    continue
+                path = self._run_path(kind)
+                write(path, merge(group))
+                for run in group:
+                    os.remove(run)
+                merged.append(path)
+            runs = merged
+        return runs
+
+    def nodes(self):
+        """
+        Yields the (id, metadata) of the nodes, ordered by id.
+        """
+        self._flush_nodes()
+        self._node_runs = self._merged_runs('nodes', self._node_runs, _merge_node_runs, _write_node_run)
+        for id_, _, metadata in _merge_node_runs(self._node_runs):
+            yield id_, json.loads(metadata)
+
+    def edges(self):
+        """
+        Yields the (source id, target id, weight) of the edges, ordered by source then target.
+        """
+        self._flush_edges()
+        self._edge_runs = self._merged_runs('edges', self._edge_runs, _merge_edge_runs, _write_edge_run)
+        return _merge_edge_runs(self._edge_runs)
+
+    def write_graphml(self, path):
+        """
+        Writes the network to a GraphML file, node by node and edge by edge.
+        Returns the number of nodes and edges written.
+        """
+        stats = {'nodes': 0, 'edges': 0}
+        keys = dict((field, 'd{0}'.format(i)) for i, field in enumerate(self.user_metadata))
+        with open(path, 'wb', 1024 * 1024) as f:
+            f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                    'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+                    'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n')
+            for field in self.user_metadata:
+                f.write('<key attr.name={0} attr.type="string" for="node" id="{1}" />\n'.format(
+                    quoteattr(field.encode('utf-8')), keys[field]))
+            f.write('<key attr.name="weight" attr.type="long" for="edge" id="weight" />\n')
+            f.write('<graph edgedefault="directed" id={0}>\n'.format(quoteattr((self.name or u'').encode('utf-8'))))
+            for id_, metadata in self.nodes():
+                data = ''.join('<data key="{0}">{1}</data>'.format(keys[field], escape(metadata[field].encode('utf-8')))
+                               for field in self.user_metadata)
+                f.write('<node id="{0}">{1}</node>\n'.format(id_, data))
+                stats['nodes'] += 1
+            for source, target, weight in self.edges():
+                f.write('<edge source="{0}" target="{1}"><data key="weight">{2}</data></edge>\n'.format(source, target, weight))
+                stats['edges'] += 1
+            f.write('</graph>\n</graphml>\n')
+        return stats
+
+    def write_csv(self, path, nodes_path):
+        """
+        Writes the edges to a CSV file at `path` (source, target, weight) and the nodes
+        to a CSV file at `nodes_path` (id and metadata).
+        Returns the number of nodes and edges written.
+        """
+        stats = {'nodes': 0, 'edges': 0}
+        lines = CSVLines()
+        with open(nodes_path, 'wb', 1024 * 1024) as f:
+            f.write(lines.encode([u'id'] + self.user_metadata))
+            for id_, metadata in self.nodes():
+                f.write(lines.encode([unicode(id_)] + [metadata[field] for field in self.user_metadata]))
+                stats['nodes'] += 1
+        with open(path, 'wb', 1024 * 1024) as f:
+            f.write('source,target,weight\n')
+            for source, target, weight in self.edges():
+                f.write('{0},{1},{2}\n'.format(source, target, weight))
+                stats['edges'] += 1
+        return stats
+
+    def close(self):
+        """
+        Removes the run files.
+        """
+        shutil.rmtree(self._directory, ignore_errors=True)
@@ -0,0 +1,146 @@
+"""
+Module contains a vectorized n-gram counter.
+
+Tokens are interned into integer ids through a vocabulary, each n-gram is packed
+into a single 64 bit integer, and n-grams are counted with numpy a batch at a time.
+Ids are only mapped back to strings for the n-grams that are asked for.
+"""
+
+import numpy as np
+from collections import Counter
+from smappPy.iter_util import get_ngrams
+
+
+class NgramCounter(object):
+    """
+    Counts the n-grams of lists of tokens. Behaves like the Counter of the joined
+    n-gram strings as far as `most_common`, `items` and `len` are concerned.
+
+    n-grams are packed with 63 / `ngram` bits per token id, so the vocabulary is
+    limited to 2 ** 21 distinct tokens for trigrams (2 ** 31 for bigrams). If that
+    is exceeded, counting falls back to a plain Counter of strings.
+    `batch_size` is the number of tokens buffered before they are counted with numpy.
+
+    Example:
+    ########
+    counter = NgramCounter(2)
+    counter.add([u'the', u'cat', u'sat'])
+    counter.add([u'the', u'cat'])
+    counter.most_common(1)
+    # => [(u'the cat', 2)]
+    """
+    def __init__(self, ngram, batch_size=1000000):
+        self.ngram = ngram
+        self.batch_size = batch_size
+        self._bits = 63 // ngram
+        self._max_tokens = 1 << self._bits
+        self._vocabulary = dict()
+        self._words = list()
+        self._pending = list()
+        self._weights = list()
+        self._codes = np.zeros(0, dtype=np.int64)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._fallback = None
+
+    def add(self, tokens, weight=1):
+        """
+        Count the n-grams of one list of tokens (e.g. one tweet), `weight` times.
+        """
+        if self._fallback is not None:
+            self._add_to_fallback(tokens, weight)
+            return
+        vocabulary = self._vocabulary
+        words = self._words
+        pending = self._pending
+        for token in tokens:
+            i = vocabulary.get(token)
+            if i is None:
+                i = vocabulary[token] = len(words)
+                words.append(token)
+            pending.append(i)
+        # -1 separates tweets, so that no n-gram spans two of them
+        pending.append(-1)
+        self._weights.extend([weight] * (len(tokens) + 1))
+        if len(words) > self._max_tokens:
+            self._switch_to_fallback()
+        elif len(pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        ids = np.array(self._pending, dtype=np.int64)
+        weights = np.array(self._weights, dtype=np.int64)
+        self._pending = list()
+        self._weights = list()
+        size = len(ids) - self.ngram + 1
+        if size < 1:
+            return
+        codes = np.zeros(size, dtype=np.int64)
+        valid = np.ones(size, dtype=bool)
+        for k in range(self.ngram):
+            column = ids[k:k+size]
+            valid &= column >= 0
+            codes = (codes << self._bits) | column
+        codes, inverse = np.unique(codes[valid], return_inverse=True)
+        counts = np.bincount(inverse, weights=weights[:size][valid]).astype(np.int64)
+        self._merge(codes, counts)
+
+    def _merge(self, codes, counts):
+        positions = np.searchsorted(self._codes, codes)
+        found = positions < len(self._codes)
+        found[found] = self._codes[positions[found]] == codes[found]
+        self._counts[positions[found]] += counts[found]
+        new = ~found
+        if new.any():
+            self._codes = np.insert(self._codes, positions[new], codes[new])
+            self._counts = np.insert(self._counts, positions[new], counts[new])
+
+    def _decode(self, code):
+        mask = self._max_tokens - 1
+        shifts = range(self._bits * (self.ngram - 1), -1, -self._bits)
+        return ' '.join(self._words[(code >> shift) & mask] for shift in shifts)
+
+    def _switch_to_fallback(self):
+        fallback = Counter()
+        for code, count in zip(self._codes, self._counts):
+            fallback[self._decode(int(code))] += int(count)
+        self._fallback = fallback
+        tokens = list()
+        for i, weight in zip(self._pending, self._weights):
+            if i < 0:
+                self._add_to_fallback(tokens, weight)
+                tokens = list()
+            else:
+                tokens.append(self._words[i])
+        self._vocabulary = self._words = self._pending = self._weights = None
+        self._codes = self._counts = None
+
+    def _add_to_fallback(self, tokens, weight):
+        ngrams = (' '.join(e) for e in get_ngrams(tokens, self.ngram))
+        if weight == 1:
+            self._fallback.update(ngrams)
+        else:
+            for ngram in ngrams:
+                self._fallback[ngram] += weight
+
+    def most_common(self, n=None):
+        if self._fallback is not None:
+            return self._fallback.most_common(n)
+        self._flush()
+        order = np.argsort(-self._counts, kind='mergesort')
+        if n is not None:
+            order = order[:n]
+        return [(self._decode(int(code)), int(count)) for code, count in zip(self._codes[order], self._counts[order])]
+
+    def items(self):
+        if self._fallback is not None:
+            return self._fallback.items()
+        self._flush()
+        return [(self._decode(int(code)), int(count)) for code, count in zip(self._codes, self._counts)]
+
+    def __len__(self):
+        if self._fallback is not None:
+            return len(self._fallback)
+        self._flush()
+        return len(self._codes)
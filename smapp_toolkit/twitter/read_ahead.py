@@ -0,0 +1,142 @@
+"""
+Background read-ahead for collection iterators.
+
+A producer thread pulls tweets from the underlying source (a BSON file or
+Mongo cursors) and hands them over in batches through a bounded queue, so that
+reading and decoding overlap with whatever the consumer does with the tweets.
+"""
+import sys
+import time
+import threading
+from Queue import Queue, Full, Empty
+
+_DONE = object()
+
+
+class _ProducerError(object):
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class ReadAheadStats(object):
+    """
+    Throughput counter for a collection with read-ahead enabled.
+
+    `tweets` and `batches` count what the background thread has handed over,
+    `seconds` is the wall-clock time spent iterating, `read_seconds` the time the
+    background thread spent reading and decoding, and `wait_seconds` the time the
+    consumer spent waiting for the next batch. A high `wait_seconds` means the
+    iteration is I/O bound, a low one means it is bound by the analysis.
+
+    Example:
+    ########
+    col = BSONTweetCollection('tweets.bson').read_ahead()
+    col.top_hashtags()
+    col.throughput()
+    # => ReadAheadStats(tweets=1200000, batches=1200, tweets/s=41253.2, wait=3.1s)
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tweets = 0
+        self.batches = 0
+        self.seconds = 0.0
+        self.read_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def _record_batch(self, size, read_seconds):
+        with self._lock:
+            self.tweets += size
+            self.batches += 1
+            self.read_seconds += read_seconds
+
+    def _record_wait(self, seconds):
+        with self._lock:
+            self.wait_seconds += seconds
+
+    def _record_iteration(self, seconds):
+        with self._lock:
+            self.seconds += seconds
+
+    @property
+    def tweets_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.tweets / self.seconds
+
+    def __repr__(self):
+        return "ReadAheadStats(tweets={0}, batches={1}, tweets/s={2:.1f}, wait={3:.1f}s)".format(
+            self.tweets, self.batches, self.tweets_per_second, self.wait_seconds)
+
+
+def read_ahead(source, batch_size=1000, queue_size=8, stats=None):
+    """
+    Iterate over `source` in a background thread, `batch_size` items at a time.
+    At most `queue_size` batches are buffered ahead of the consumer.
+    Exceptions raised by `source` are re-raised in the consuming thread.
+    """
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        it = iter(source)
+        try:
+            batch = []
+            started = time.time()
+            for item in it:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if stats is not None:
+                        stats._record_batch(len(batch), time.time() - started)
+                    if not put(batch):
+                        return
+                    batch = []
+                    started = time.time()
+            if batch:
+                if stats is not None:
+                    stats._record_batch(len(batch), time.time() - started)
+                if not put(batch):
+                    return
+            put(_DONE)
+        except Exception:
+            put(_ProducerError(sys.exc_info()))
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+
+    producer = threading.Thread(target=produce, name='smapp-read-ahead')
+    producer.daemon = True
+    producer.start()
+
+    started = time.time()
+    try:
+        while True:
+            waited = time.time()
+            while True:
+                try:
+                    batch = queue.get(timeout=0.1)
+                    break
+                except Empty:
+                    if not producer.is_alive() and queue.empty():
+                        raise RuntimeError("Read-ahead thread died without finishing")
+            if stats is not None:
+                stats._record_wait(time.time() - waited)
+            if batch is _DONE:
+                return
+            if isinstance(batch, _ProducerError):
+                exc_type, exc_value, exc_tb = batch.exc_info
+                raise exc_type, exc_value, exc_tb
+            for item in batch:
+                yield item
+    finally:
+        stop.set()
+        if stats is not None:
+            stats._record_iteration(time.time() - started)
@@ -0,0 +1,223 @@
+"""
+Module contains bounded-memory, mergeable summaries used to approximate counts
+over collections too large to count exactly.
+
+All summaries can be pickled, and summaries built over different parts of the
+data (time slices, files, workers) can be merged into a summary of the union.
+"""
+
+import math
+import heapq
+import struct
+import hashlib
+import pandas as pd
+from collections import Counter, OrderedDict
+
+
+class FrequentItems(object):
+    """
+    Approximate counter of the most frequent items, with bounded memory
+    (the mergeable Misra-Gries summary).
+
+    Holds at most 2 * `capacity` counters. A reported count never overestimates
+    the true count, and underestimates it by at most `error`, where
+    `error` <= `total` / (`capacity` + 1) and `total` is the number of items added.
+    So any item that makes up more than 1 / (`capacity` + 1) of the total is
+    guaranteed to be in the summary.
+
+    Exposes the parts of the Counter interface used by the top_x() functions
+    (`update`, `most_common`, `items`, `len`).
+
+    Example:
+    ########
+    top = FrequentItems(capacity=1000)
+    top.update(['#a', '#b', '#a'])
+    top.most_common(1)
+    # => [('#a', 2)]
+    top.count_bounds('#a')
+    # => (2, 2)
+    """
+    def __init__(self, capacity=10000):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.counts = Counter()
+        self.error = 0
+        self.total = 0
+
+    def update(self, items):
+        """
+        Count `items`: an iterable of items, or a mapping of item -> count.
+        """
+        counts = self.counts
+        limit = 2 * self.capacity
+        if hasattr(items, 'iteritems'):
+            for item, count in items.iteritems():
+                counts[item] += count
+                self.total += count
+                if len(counts) > limit:
+                    self._prune()
+                    counts = self.counts
+        else:
+            for item in items:
+                counts[item] += 1
+                self.total += 1
+                if len(counts) > limit:
+                    self._prune()
+                    counts = self.counts
+
+    def merge(self, other):
+        """
+        Merge another FrequentItems into this one. The error bound holds for the union.
+        """
+        self.counts.update(other.counts)
+        self.error += other.error
+        self.total += other.total
+        self._prune()
+        return self
+
+    def _prune(self):
+        if len(self.counts) <= self.capacity:
+            return
+        cut = heapq.nlargest(self.capacity + 1, self.counts.itervalues())[-1]
+        self.error += cut
+        self.counts = Counter(dict((item, count - cut) for item, count in self.counts.iteritems() if count > cut))
+
+    def count_bounds(self, item):
+        """
+        Returns (lower, upper) bounds of the true count of `item`.
+        """
+        count = self.counts[item]
+        return (count, count + self.error)
+
+    def most_common(self, n=None):
+        return self.counts.most_common(n)
+
+    def items(self):
+        return self.counts.items()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __repr__(self):
+        return "FrequentItems(capacity={0}, items={1}, total={2}, error<={3})".format(
+            self.capacity, len(self.counts), self.total, self.error)
+
+
+def _hash64(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return struct.unpack('<Q', hashlib.md5(str(value)).digest()[:8])[0]
+
+
+class HyperLogLog(object):
+    """
+    Approximate count of distinct values (the HyperLogLog sketch).
+
+    Uses 2 ** `precision` bytes (16KB for the default precision of 14), whatever the
+    number of values added. The relative standard error of the count is
+    1.04 / sqrt(2 ** `precision`): about 0.8% for precision 14, 0.4% for 16.
+
+    Sketches with the same precision can be merged (`a.merge(b)` or `a |= b`);
+    the result is the sketch of the union, so e.g. daily sketches of user ids can
+    be rolled up into weekly unique users without reading the tweets again.
+    `add`, `update` and `|=` mirror the set interface, `len()` is the estimate.
+
+    Example:
+    ########
+    users = HyperLogLog()
+    users.update(tweet['user']['id'] for tweet in collection)
+    len(users)
+    """
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        x = _hash64(value)
+        p = self.precision
+        index = x >> (64 - p)
+        rest = x & ((1 << (64 - p)) - 1)
+        rank = (64 - p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Can not merge sketches with different precisions")
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def __ior__(self, other):
+        return self.merge(other)
+
+    def copy(self):
+        ret = HyperLogLog(self.precision)
+        ret.registers = bytearray(self.registers)
+        return ret
+
+    @staticmethod
+    def union(*sketches):
+        ret = sketches[0].copy()
+        for sketch in sketches[1:]:
+            ret.merge(sketch)
+        return ret
+
+    def count(self):
+        m = len(self.registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return estimate
+
+    def __len__(self):
+        return int(round(self.count()))
+
+    def __repr__(self):
+        return "HyperLogLog(precision={0}, count~{1})".format(self.precision, len(self))
+
+
+def rollup_sketches(sketches, freq):
+    """
+    Merges a time-indexed Series of sketches (e.g. from `group_by('days').unique_user_sketches()`)
+    into coarser periods. `freq` is a pandas period alias: 'W' (weeks), 'M' (months), ...
+    Returns a Series of merged sketches indexed by the start of each period.
+
+    Example:
+    ########
+    daily = collection.group_by('days').unique_user_sketches()
+    weekly_unique_users = rollup_sketches(daily, 'W').map(len)
+    """
+    merged = OrderedDict()
+    for period, sketch in zip(sketches.index.to_period(freq), sketches):
+        if period in merged:
+            merged[period].merge(sketch)
+        else:
+            merged[period] = sketch.copy()
+    return pd.Series(merged.values(), index=[period.start_time for period in merged])
+
+
+def _new_counter(capacity=None):
+    """
+    An exact Counter, or a FrequentItems summary if `capacity` is given.
+    """
+    if capacity:
+        return FrequentItems(capacity)
+    return Counter()
+
+def _merge_counters(counter, other):
+    if isinstance(counter, FrequentItems):
+        return counter.merge(other)
+    counter.update(other)
+    return counter
@@ -0,0 +1,69 @@
+"""
+Module contains functions to assign timestamps to time buckets with integer
+arithmetic on epoch nanoseconds, a whole batch of timestamps at a time.
+"""
+
+import pytz
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+BUCKET_NANOSECONDS = {
+    'seconds': 10**9,
+    'minutes': 60 * 10**9,
+    'hours': 60 * 60 * 10**9,
+    'days': 24 * 60 * 60 * 10**9,
+}
+
+def epoch_nanoseconds(timestamps):
+    """
+    Converts a list of datetimes to an int64 array of nanoseconds since the epoch
+    (UTC for timezone-aware datetimes).
+    """
+    if len(timestamps) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return pd.DatetimeIndex(timestamps).asi8
+
+# time units that are coarser than each other, finest first ('months' are not made of 'weeks')
+TIME_UNITS = ['seconds', 'minutes', 'hours', 'days', 'weeks', 'months']
+
+# 1970-01-01 was a Thursday, weeks start on Mondays
+_WEEK_OFFSET = 3 * BUCKET_NANOSECONDS['days']
+
+def bucket_starts(timestamps, time_unit):
+    """
+    Returns the start of the `time_unit` bucket of each timestamp, in epoch nanoseconds.
+    Weeks start on Mondays, months on their first day.
+    """
+    if time_unit not in TIME_UNITS:
+        raise ValueError("Illegal time unit ({}). Legal values are {}.".format(time_unit, TIME_UNITS))
+    nanoseconds = epoch_nanoseconds(timestamps)
+    if time_unit == 'weeks':
+        week = 7 * BUCKET_NANOSECONDS['days']
+        return nanoseconds - (nanoseconds + _WEEK_OFFSET) % week
+    if time_unit == 'months':
+        return nanoseconds.astype('datetime64[ns]').astype('datetime64[M]').astype('datetime64[ns]').astype(np.int64)
+    return nanoseconds - nanoseconds % BUCKET_NANOSECONDS[time_unit]
+
+def is_coarser(time_unit, than):
+    """
+    Whether every `than` bucket falls within a single `time_unit` bucket.
+    """
+    if time_unit not in TIME_UNITS or than not in TIME_UNITS:
+        raise ValueError("Illegal time unit. Legal values are {}.".format(TIME_UNITS))
+    if (than, time_unit) == ('weeks', 'months'):
+        return False
+    return TIME_UNITS.index(time_unit) > TIME_UNITS.index(than)
+
+_EPOCH = datetime(1970, 1, 1)
+
+def bucket_number(timestamp, time_unit):
+    """
+    Index of the `time_unit` bucket of a single timestamp, counted from the epoch
+    ('seconds', 'minutes', 'hours' or 'days'). For tweets handled one at a time.
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(pytz.UTC).replace(tzinfo=None)
+    delta = timestamp - _EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+    return microseconds * 1000 // BUCKET_NANOSECONDS[time_unit]
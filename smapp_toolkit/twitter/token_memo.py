@@ -0,0 +1,79 @@
+"""
+Module contains a memo of tokenized tweet texts, so that texts repeated across
+many tweets (retweets above all) are only tokenized once.
+"""
+
+from collections import OrderedDict
+
+
+def _text_key(tweet):
+    """
+    Retweets are keyed by the id of the retweeted tweet (they all share its text),
+    other tweets by their text.
+    """
+    retweeted = tweet.get('retweeted_status')
+    if retweeted is not None and 'id' in retweeted:
+        return retweeted['id']
+    return tweet['text']
+
+
+class TokenMemo(object):
+    """
+    Bounded LRU memo of `tokenize(tweet['text'])`. Holds the tokens of at most
+    `size` distinct texts; the least recently used are dropped first.
+
+    Example:
+    ########
+    memo = TokenMemo(lambda text: text.lower().split())
+    for tweet in collection:
+        tokens = memo.tokens(tweet)
+    memo.hits, memo.misses
+    """
+    def __init__(self, tokenize, size=100000):
+        self._tokenize = tokenize
+        self._size = size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def tokens(self, tweet, key=None):
+        if key is None:
+            key = _text_key(tweet)
+        cache = self._cache
+        try:
+            tokens = cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            tokens = self._tokenize(tweet['text'])
+            self.misses += 1
+            if len(cache) >= self._size:
+                cache.popitem(last=False)
+        cache[key] = tokens
+        return tokens
+
+
+def weighted_tokens(tweets, tokenize, memo_size=100000, batch_size=10000):
+    """
+    Tokenizes the text of each tweet in `tweets` and yields (tokens, multiplicity)
+    pairs: within each batch of `batch_size` tweets, every distinct text is yielded
+    once, with the number of tweets that had it. Tokens are memoized across batches
+    in a TokenMemo of `memo_size` texts.
+    """
+    memo = TokenMemo(tokenize, memo_size)
+    batch = dict()
+    i = 0
+    for tweet in tweets:
+        key = _text_key(tweet)
+        entry = batch.get(key)
+        if entry is None:
+            batch[key] = [memo.tokens(tweet, key), 1]
+        else:
+            entry[1] += 1
+        i += 1
+        if i >= batch_size:
+            for tokens, count in batch.itervalues():
+                yield tokens, count
+            batch = dict()
+            i = 0
+    for tokens, count in batch.itervalues():
+        yield tokens, count
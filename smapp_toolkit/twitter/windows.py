@@ -0,0 +1,158 @@
+"""
+Module contains streaming sliding-window counters, for rolling "last hour" counts
+and burst detection over tweets as they arrive.
+"""
+
+import numpy as np
+import pandas as pd
+from collections import Counter
+
+from aggregates import FEATURES
+from time_buckets import BUCKET_NANOSECONDS, bucket_number
+
+
+class SlidingWindow(object):
+    """
+    Counts the terms of the tweets in the last `size` time buckets ('seconds', 'minutes',
+    'hours' or 'days'). Each bucket is a Counter in a ring buffer, and the window totals
+    are updated as tweets are added and as buckets expire, so memory stays proportional
+    to the window whatever the number of tweets seen.
+
+    Terms are the `feature` of each tweet ('hashtags', 'mentions', 'urls', 'links',
+    'images' or 'geolocation_names'), or whatever `terms(tweet)` returns.
+    Tweets older than the window are dropped (and counted in `dropped`).
+
+    Example:
+    ########
+    window = SlidingWindow(size=60, time_unit='minutes', feature='hashtags')
+    window.update(collection.since(datetime.utcnow() - timedelta(hours=1)))
+    window.top(10)
+    # later, as new tweets arrive
+    window.update(new_tweets)
+    window.bursts(threshold=3)
+    """
+    def __init__(self, size=60, time_unit='minutes', feature='hashtags', terms=None):
+        if time_unit not in BUCKET_NANOSECONDS:
+            raise ValueError("Illegal time unit ({}). Legal values are {}.".format(time_unit, sorted(BUCKET_NANOSECONDS)))
+        if size < 2:
+            raise ValueError("A window needs at least 2 buckets")
+        self.size = size
+        self.time_unit = time_unit
+        self._terms = terms or FEATURES[feature]
+        self._buckets = [Counter() for _ in range(size)]
+        self._tweets = [0] * size
+        self._totals = Counter()
+        self._last = None
+        self.dropped = 0
+
+    def __repr__(self):
+        return "SlidingWindow(size={0}, time_unit={1}, terms={2}, tweets={3})".format(
+            self.size, self.time_unit, len(self._totals), sum(self._tweets))
+
+    def add(self, tweet):
+        bucket = bucket_number(tweet['timestamp'], self.time_unit)
+        if self._last is None:
+            self._last = bucket
+        elif bucket > self._last:
+            self._advance_to(bucket)
+        elif bucket <= self._last - self.size:
+            self.dropped += 1
+            return
+        slot = bucket % self.size
+        counts = self._buckets[slot]
+        for term in self._terms(tweet):
+            counts[term] += 1
+            self._totals[term] += 1
+        self._tweets[slot] += 1
+
+    def update(self, tweets):
+        for tweet in tweets:
+            self.add(tweet)
+
+    def advance(self, timestamp):
+        """
+        Move the window forward to `timestamp` (e.g. `datetime.utcnow()`), expiring old
+        buckets even if no tweets arrived.
+        """
+        bucket = bucket_number(timestamp, self.time_unit)
+        if self._last is None:
+            self._last = bucket
+        elif bucket > self._last:
+            self._advance_to(bucket)
+
+    def _advance_to(self, bucket):
+        for expired in range(max(self._last + 1, bucket - self.size + 1), bucket + 1):
+            slot = expired % self.size
+            totals = self._totals
+            for term, count in self._buckets[slot].iteritems():
+                totals[term] -= count
+                if totals[term] <= 0:
+                    del totals[term]
+            self._buckets[slot] = Counter()
+            self._tweets[slot] = 0
+        self._last = bucket
+
+    def _window(self):
+        """
+        Bucket numbers of the window, oldest first.
+        """
+        if self._last is None:
+            return []
+        return range(self._last - self.size + 1, self._last + 1)
+
+    def _index(self, buckets):
+        return pd.to_datetime(np.array(buckets, dtype=np.int64) * BUCKET_NANOSECONDS[self.time_unit])
+
+    def top(self, n=10):
+        """
+        Returns the `n` most frequent terms over the window, as a pandas Series.
+        """
+        if not self._totals:
+            return pd.Series()
+        names, counts = zip(*self._totals.most_common(n))
+        return pd.Series(counts, index=names)
+
+    def tweet_counts(self):
+        """
+        Returns the number of tweets in each bucket of the window, as a pandas Series.
+        """
+        buckets = self._window()
+        return pd.Series([self._tweets[b % self.size] for b in buckets], index=self._index(buckets))
+
+    def counts(self, n=10):
+        """
+        Returns the counts of the `n` most frequent terms of the window in each of its
+        buckets, as a DataFrame with a row per bucket.
+        """
+        buckets = self._window()
+        terms = [term for term, _ in self._totals.most_common(n)]
+        data = [[self._buckets[b % self.size][term] for term in terms] for b in buckets]
+        return pd.DataFrame(data, index=self._index(buckets), columns=terms)
+
+    def bursts(self, threshold=3.0, min_count=5):
+        """
+        Returns the terms of the latest bucket whose count is at least `min_count` and
+        `threshold` standard deviations above their mean count in the earlier buckets of
+        the window (the standard deviation is taken to be at least 1, so that terms that
+        were absent until now need `threshold` + mean tweets to burst).
+        Returns a DataFrame with the 'count', 'mean', 'std' and 'zscore' of each bursting
+        term, highest z-score first.
+        """
+        columns = ['count', 'mean', 'std', 'zscore']
+        if self._last is None:
+            return pd.DataFrame(columns=columns)
+        latest = self._buckets[self._last % self.size]
+        candidates = [term for term, count in latest.iteritems() if count >= min_count]
+        earlier = [self._buckets[b % self.size] for b in self._window()[:-1]]
+        rows = dict()
+        for term in candidates:
+            history = np.array([counts[term] for counts in earlier], dtype=np.float64)
+            mean, std = history.mean(), history.std()
+            zscore = (latest[term] - mean) / max(std, 1.0)
+            if zscore >= threshold:
+                rows[term] = [latest[term], mean, std, zscore]
+        if not rows:
+            return pd.DataFrame(columns=columns)
+        ret = pd.DataFrame.from_dict(rows, orient='index')
+        ret.columns = columns
+        return ret.sort_values('zscore', ascending=False)